@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+predict = pytest.importorskip('ventmapper.deep.predict', exc_type=ImportError)
+
+
+class OnesModel(object):
+    """ Model predicting one label everywhere
+    """
+    input_shape = (None, 1, 128, 128, 128)
+
+    def predict(self, batch, batch_size=None):
+        return np.ones((len(batch), 1) + batch.shape[2:], dtype=np.float32)
+
+
+@pytest.mark.parametrize('step', [1, 64, 128, 200])
+def test_patch_starts_cover_axis(step):
+    dim, patch = 300, 128
+    covered = np.zeros(dim, dtype=bool)
+    for start in predict.get_patch_starts(dim, patch, step):
+        covered[start:start + patch] = True
+
+    assert covered.all()
+
+
+def test_step_larger_than_patch_has_no_nan():
+    data = np.random.RandomState(0).rand(1, 300, 140, 130).astype(np.float32)
+    prediction = predict.predict_sliding_window(OnesModel(), data, step=200, batch_size=4)
+
+    assert prediction.shape == (1, 1, 300, 140, 130)
+    assert not np.isnan(prediction).any()
+    np.testing.assert_allclose(prediction, 1, rtol=1e-5)
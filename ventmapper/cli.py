@@ -4,18 +4,14 @@
 
 import argcomplete
 import argparse
+import contextlib
+import importlib
 import logging
 import os
 import sys
 import warnings
 
 from ventmapper import __version__
-from ventmapper import gui
-from ventmapper.segment import ventmapper
-from ventmapper.convert import filetype
-from ventmapper.preprocess import biascorr, trim_like
-from ventmapper.qc import seg_qc
-from ventmapper.stats import summary_vent_vols
 from ventmapper.utils.depends_manager import add_paths
 
 warnings.simplefilter("ignore")
@@ -28,92 +24,180 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
 # --------------
 # functions
 
+# subcommand modules (and their heavy dependencies: keras, nipype, nilearn, ...) are only imported when run
+
 
 def run_filetype(args):
+    from ventmapper.convert import filetype
     filetype.main(args)
 
 
 def run_ventmapper(args):
+    from ventmapper.segment import ventmapper
     ventmapper.main(args)
 
 
+def run_seg_cohort(args):
+    from ventmapper.segment import cohort
+    cohort.main(args)
+
+
+def run_serve(args):
+    from ventmapper.segment import serve
+    serve.main(args)
+
+
+def run_compare_precision(args):
+    from ventmapper.deep import compare_precision
+    compare_precision.main(args)
+
+
+def run_export(args):
+    from ventmapper.deep import export
+    sys.exit(export.main(args))
+
+
 def run_vent_seg_summary(args):
+    from ventmapper.stats import summary_vent_vols
     summary_vent_vols.main(args)
 
 
+def run_label_geom(args):
+    from ventmapper.stats import label_geom
+    label_geom.main(args)
+
+
 def run_seg_qc(args):
+    from ventmapper.qc import seg_qc
     seg_qc.main(args)
 
 
 def run_utils_biascorr(args):
+    from ventmapper.preprocess import biascorr
     biascorr.main(args)
 
 
 def run_trim_like(args):
+    from ventmapper.preprocess import trim_like
     trim_like.main(args)
 
+
+def run_standardize(args):
+    from ventmapper.preprocess import standardize
+    standardize.main(args)
+
+
+def run_bench(args):
+    from ventmapper.utils import bench
+    bench.main(args)
+
+
+def run_trace_summary(args):
+    from ventmapper.utils import trace_summary
+    trace_summary.main(args)
+
+
+def run_doctor(args):
+    from ventmapper.utils import doctor
+    sys.exit(doctor.main(args))
+
 # --------------
 # parser
 
 
-def get_parser():
+# subcommand: module defining its parser (parsefn), run function, help
+SUBCOMMANDS = [
+    ('seg_vent', 'ventmapper.segment.ventmapper', run_ventmapper, "Segment ventricles using a trained CNN"),
+    ('seg_cohort', 'ventmapper.segment.cohort', run_seg_cohort,
+     "Segment ventricles of a cohort with parallel workers"),
+    ('serve', 'ventmapper.segment.serve', run_serve, "Run a local daemon that keeps the ventricle models loaded"),
+    ('prec_check', 'ventmapper.deep.compare_precision', run_compare_precision,
+     "Compare reduced-precision against full-precision predictions"),
+    ('export_model', 'ventmapper.deep.export', run_export,
+     "Export models to portable graphs (pb, onnx) and check parity"),
+    ('seg_qc', 'ventmapper.qc.seg_qc', run_seg_qc, "Create tiled mosaic of segmentation overlaid on structural image"),
+    ('bias_corr', 'ventmapper.preprocess.biascorr', run_utils_biascorr, "Bias field correct images using N4"),
+    ('std_img', 'ventmapper.preprocess.standardize', run_standardize,
+     "Standardize intensities by local mean and std within a brain mask"),
+    ('filetype', 'ventmapper.convert.filetype', run_filetype, "Convert the Analyse format to Nifti"),
+    ('stats_vent', 'ventmapper.stats.summary_vent_vols', run_vent_seg_summary,
+     "Generates volumetric summary of ventricular segmentations"),
+    ('stats_geom', 'ventmapper.stats.label_geom', run_label_geom,
+     "Generates geometry summary (volume, surface area, shape) of left and right ventricles"),
+    ('trim_like', 'ventmapper.preprocess.trim_like', run_trim_like,
+     'Trim or expand image in same space like reference'),
+    ('bench', 'ventmapper.utils.bench', run_bench, "Benchmark time and peak memory of each pipeline stage"),
+    ('trace_summary', 'ventmapper.utils.trace_summary', run_trace_summary,
+     "Summarize stage traces of a cohort to find slow stages and outliers"),
+    ('doctor', 'ventmapper.utils.doctor', run_doctor, "Report the location and version of the required tools"),
+]
+
+# subcommands that run without the required tools
+NO_DEPENDS = ['doctor']
+
+# options of the main parser followed by a value
+VALUE_OPTIONS = ['--profile_top']
+
+USAGES = {'trim_like': '%(prog)s -i [ img ] -r [ ref ] -o [ out ] \n\n'
+                       'Trim or expand image in same space like reference'}
+
+
+def get_subcommand(args):
+    """
+    Subcommand of the command line arguments: their first positional argument, as options of the subcommand
+    can have values named like a subcommand (ex: a subject dir named stats_vent). None if there is none
+    """
+    names = [subcommand[0] for subcommand in SUBCOMMANDS]
+
+    args = iter(args)
+    for arg in args:
+        if arg in VALUE_OPTIONS:
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg if arg in names else None
+
+    return None
+
+
+# parsers of the subcommands built so far (the gui reuses them for its help and option widgets)
+_subparsers = {}
+
+
+def get_subparser(name):
+    """
+    Parser of a subcommand, importing its module on first use
+    :param name: subcommand (ex: seg_vent)
+    :return: parser
+    """
+    if name not in _subparsers:
+        module_name = next(subcommand[1] for subcommand in SUBCOMMANDS if subcommand[0] == name)
+        sub_parser = importlib.import_module(module_name).parsefn()
+        sub_parser.prog = 'ventmapper %s' % name
+        if name in USAGES:
+            sub_parser.usage = USAGES[name]
+        _subparsers[name] = sub_parser
+
+    return _subparsers[name]
+
+
+def get_parser(load=None):
+    """
+    Build the cli parser
+    :param load: subcommands whose options are loaded, importing their modules (default: all)
+    :return: parser
+    """
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
-    # --------------
-
-    # seg ventricles (vent)
-    vent_parser = ventmapper.parsefn()
-    parser_seg_vent = subparsers.add_parser('seg_vent', add_help=False, parents=[vent_parser],
-                                            help="Segment ventricles using a trained CNN",
-                                            usage=vent_parser.usage)
-    parser_seg_vent.set_defaults(func=run_ventmapper)
-
-    # --------------
-
-    # seg qc
-    seg_qc_parser = seg_qc.parsefn()
-    parser_seg_qc = subparsers.add_parser('seg_qc', add_help=False, parents=[seg_qc_parser],
-                                          help="Create tiled mosaic of segmentation overlaid on structural image",
-                                          usage=seg_qc_parser.usage)
-    parser_seg_qc.set_defaults(func=run_seg_qc)
-
-    # --------------
-
-    # utils biascorr
-    biascorr_parser = biascorr.parsefn()
-    parser_utils_biascorr = subparsers.add_parser('bias_corr', add_help=False, parents=[biascorr_parser],
-                                                  help="Bias field correct images using N4",
-                                                  usage=biascorr_parser.usage)
-    parser_utils_biascorr.set_defaults(func=run_utils_biascorr)
-
-    # --------------
-
-    # filetype
-    filetype_parser = filetype.parsefn()
-    parser_filetype = subparsers.add_parser('filetype', add_help=False, parents=[filetype_parser],
-                                            help="Convert the Analyse format to Nifti",
-                                            usage=filetype_parser.usage)
-    parser_filetype.set_defaults(func=run_filetype)
-
-    # --------------
-
-    # vent vol seg
-    vent_vol_parser = summary_vent_vols.parsefn()
-    parser_stats_vent = subparsers.add_parser('stats_vent', add_help=False, parents=[vent_vol_parser],
-                                            help="Generates volumetric summary of ventricular segmentations",
-                                            usage=vent_vol_parser.usage)
-    parser_stats_vent.set_defaults(func=run_vent_seg_summary)
-
-    # --------------
-
-    # trim like
-    trim_parser = trim_like.parsefn()
-
-    parser_trim_like = subparsers.add_parser('trim_like', help='Trim or expand image in same space like reference',
-                                             add_help=False, parents=[trim_parser],
-                                             usage='%(prog)s -i [ img ] -r [ ref ] -o [ out ] \n\n'
-                                                   'Trim or expand image in same space like reference')
-    parser_trim_like.set_defaults(func=run_trim_like)
+
+    for name, module_name, func, help_str in SUBCOMMANDS:
+        if load is None or name in load:
+            sub_parser = get_subparser(name)
+            parser_sub = subparsers.add_parser(name, add_help=False, parents=[sub_parser], help=help_str,
+                                               usage=sub_parser.usage)
+        else:
+            # listed in the help only
+            parser_sub = subparsers.add_parser(name, help=help_str)
+        parser_sub.set_defaults(func=func)
 
     # --------------------
 
@@ -121,6 +205,13 @@ def get_parser():
     parser.add_argument('-v', '--version', action='version',
                         version='%(prog)s {version}'.format(version=__version__))
 
+    # profiling
+    parser.add_argument('--profile', action='store_true',
+                        help="profile the subcommand (python calls and external commands), saving the profile "
+                             "next to its log (workers of seg_cohort are not profiled)")
+    parser.add_argument('--profile_top', type=int, metavar='', default=30,
+                        help="number of functions in the profile summary (default: %(default)s)")
+
     return parser
 
 
@@ -132,7 +223,8 @@ def main(args=None):
     if args is None:
         args = sys.argv[1:]
 
-    parser = get_parser()
+    # only the subcommand being run is loaded, completion needs all of them
+    parser = get_parser(None if '_ARGCOMPLETE' in os.environ else [get_subcommand(args)])
     argcomplete.autocomplete(parser)
     args = parser.parse_args(args)
 
@@ -140,6 +232,7 @@ def main(args=None):
 
         # set filename, file path for the log file
         log_filename = args.func.__name__.split('run_')[1]
+        log_filepath = os.path.join(os.getcwd(), '{}.log'.format(log_filename))
         if hasattr(args, 'subj'):
             if args.subj:
                 log_filepath = os.path.join(args.subj, 'logs', '{}.log'.format(log_filename))
@@ -148,9 +241,6 @@ def main(args=None):
                 if args.t1w:
                     log_filepath = os.path.join(os.path.dirname(args.t1w), 'logs', '{}.log'.format(log_filename))
 
-        else:
-            log_filepath = os.path.join(os.getcwd(), '{}.log'.format(log_filename))
-
         os.makedirs(os.path.dirname(log_filepath), exist_ok=True)
 
         # log keeps console output and redirects to file
@@ -160,10 +250,18 @@ def main(args=None):
         handler.setFormatter(formatter)
         root.addHandler(handler)
 
-        with add_paths():
-            args.func(args)
+        # subcommands running without the required tools do not look them up
+        paths = contextlib.nullcontext() if log_filename in NO_DEPENDS else add_paths()
+
+        with paths:
+            if args.profile:
+                from ventmapper.utils import profiler
+                profiler.profile_call(args.func, args, os.path.splitext(log_filepath)[0], top=args.profile_top)
+            else:
+                args.func(args)
 
     else:
+        from ventmapper import gui
         gui.main()
 
 
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import json
+import os
+import numpy as np
+
+BACKENDS = ['keras', 'pb', 'onnx']
+PRECISIONS = ['float32', 'float16', 'bfloat16', 'int8']
+# precisions that change the computation (bfloat16 and int8 only quantize the weights, computing in float32)
+INFER_PRECISIONS = ['float32', 'float16']
+
+
+def get_artifact(model_json, backend, precision='float32'):
+    """
+    Get the exported graph of a model (ex: models/vent_t1only_model_float16.pb)
+    :param model_json: model architecture (json)
+    :param backend: 'pb' (frozen tensorflow graph) or 'onnx'
+    :param precision: precision the graph was exported with
+    :return: exported graph file
+    """
+    base = os.path.splitext(model_json)[0]
+    suffix = '' if precision == 'float32' else '_%s' % precision
+
+    return '%s%s.%s' % (base, suffix, backend)
+
+
+class FrozenGraphModel(object):
+    """ Runs a frozen tensorflow graph exported by 'ventmapper export_model -f pb'
+    """
+    def __init__(self, graph_file, config=None):
+        import tensorflow as tf
+
+        with open('%s.json' % graph_file, 'r') as json_file:
+            meta = json.load(json_file)
+
+        graph_def = tf.GraphDef()
+        with open(graph_file, 'rb') as in_file:
+            graph_def.ParseFromString(in_file.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        self.input = self.graph.get_tensor_by_name(meta['input'])
+        self.output = self.graph.get_tensor_by_name(meta['output'])
+        self.input_shape = tuple(meta['input_shape'])
+        self.session = tf.Session(graph=self.graph, config=config)
+
+    def predict(self, data, batch_size=None):
+        batch_size = batch_size if batch_size else len(data)
+
+        return np.concatenate([self.session.run(self.output, {self.input: data[b:b + batch_size]})
+                               for b in range(0, len(data), batch_size)])
+
+
+class OnnxModel(object):
+    """ Runs an onnx graph exported by 'ventmapper export_model -f onnx' with onnxruntime
+    """
+    def __init__(self, onnx_file, num_threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("\n\n Please install onnxruntime to run onnx models:\n 'pip install onnxruntime'")
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+
+        self.session = onnxruntime.InferenceSession(onnx_file, options)
+        model_input = self.session.get_inputs()[0]
+
+        self.input_name = model_input.name
+        self.input_dtype = np.float16 if 'float16' in model_input.type else np.float32
+        self.input_shape = tuple(dim if isinstance(dim, int) else None for dim in model_input.shape)
+
+    def predict(self, data, batch_size=None):
+        batch_size = batch_size if batch_size else len(data)
+        data = data.astype(self.input_dtype, copy=False)
+
+        return np.concatenate([self.session.run(None, {self.input_name: data[b:b + batch_size]})[0]
+                               for b in range(0, len(data), batch_size)])
+
+
+def load_backend(graph_file, backend, config=None, num_threads=None):
+    """
+    Load an exported graph
+    :param graph_file: exported graph
+    :param backend: 'pb' or 'onnx'
+    :param config: tensorflow session config (pb)
+    :param num_threads: intra-op threads (onnx)
+    :return: model with a keras-like predict method and input_shape
+    """
+    assert os.path.exists(graph_file), \
+        "%s does not exist ... please export it with 'ventmapper export_model -f %s'" % (graph_file, backend)
+
+    if backend == 'pb':
+        return FrozenGraphModel(graph_file, config)
+    elif backend == 'onnx':
+        return OnnxModel(graph_file, num_threads)
+
+    raise ValueError("unknown backend: %s" % backend)
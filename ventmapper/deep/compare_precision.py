@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argcomplete
+import argparse
+import numpy as np
+import os
+import sys
+import time
+import pandas as pd
+from termcolor import colored
+
+from ventmapper.deep.backend import PRECISIONS
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage='%(prog)s -i [ in_dir ] \n\n'
+                                           "Compare reduced-precision against full-precision ventricle predictions")
+
+    required = parser.add_argument_group('required arguments')
+
+    required.add_argument('-i', '--in_dir', type=str, required=True, metavar='',
+                          help="directory of subjects or text file with one subject dir per line")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-p', '--precisions', type=str, nargs='+', metavar='',
+                          default=['float16', 'bfloat16', 'int8'], choices=PRECISIONS,
+                          help="precisions to compare: %s (default: %%(default)s)" % ', '.join(PRECISIONS))
+    optional.add_argument('-e', '--engine', type=str, metavar='', default='c3d', choices=['c3d', 'numpy'],
+                          help="preprocessing engine (default: %(default)s)")
+    optional.add_argument('-th', '--thresh', type=float, metavar='', default=0.5,
+                          help="threshold of probability maps (default: %(default)s)")
+    optional.add_argument('-o', '--out_csv', type=str, metavar='', default='precision_dice.csv',
+                          help="output csv (default: %(default)s)")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    return args.in_dir, args.precisions, args.engine, args.thresh, args.out_csv
+
+
+def dice(seg, ref):
+    """
+    Dice overlap of two binary arrays (1 if both are empty)
+    """
+    total = np.count_nonzero(seg) + np.count_nonzero(ref)
+
+    return 1. if total == 0 else 2. * np.count_nonzero(seg & ref) / total
+
+
+def timed_predict(model, test_data):
+    """
+    Predict a subject, timing a second call so the graph and session setup of the first one is not counted
+    :return: prediction, seconds
+    """
+    model.predict(test_data[np.newaxis])  # warm up
+    start = time.time()
+    prediction = model.predict(test_data[np.newaxis]).astype(np.float32, copy=False)
+
+    return prediction, time.time() - start
+
+
+def main(args):
+    parser = parsefn()
+    in_dir, precisions, engine, thresh, out_csv = parse_inputs(parser, args)
+
+    from ventmapper.deep.predict import get_model
+    from ventmapper.segment.ventmapper import get_model_files, get_model_name, get_pred_dir, parse_cohort_inputs, \
+        preprocess_subj
+    from ventmapper.utils.stage_cache import StageCache
+
+    rows = []
+    for subj_dir, subj, t1, fl, t2, mask, out, force in parse_cohort_inputs(in_dir, True):
+        print(colored("\n comparing precisions on %s" % subj, 'green'))
+
+        test_seqs, training_mods, model_name = get_model_name(t1, fl, t2)
+        model_json, model_weights = get_model_files(model_name)
+
+        test_data, res_affine, t1_img, t1_orient = preprocess_subj(subj_dir, t1, test_seqs, training_mods, mask,
+                                                                   [128, 128, 128], engine=engine,
+                                                                   cache=StageCache(get_pred_dir(subj_dir)))
+
+        ref, ref_time = timed_predict(get_model(model_name, model_json, model_weights, 'float32'), test_data)
+        rows.append([subj, model_name, 'float32', 1., 0., ref_time])
+
+        for precision in precisions:
+            pred, pred_time = timed_predict(get_model(model_name, model_json, model_weights, precision), test_data)
+            rows.append([subj, model_name, precision, dice(pred > thresh, ref > thresh),
+                         float(np.abs(pred - ref).max()), pred_time])
+
+    df = pd.DataFrame(rows, columns=['Subjects', 'Model', 'Precision', 'Dice', 'Max_Prob_Diff', 'Seconds'])
+    df.round(5).to_csv(out_csv, index=False)
+
+    print("\n Dice against float32 predictions:\n")
+    print(df.groupby('Precision').agg({'Dice': ['mean', 'min'], 'Max_Prob_Diff': 'max', 'Seconds': 'median'})
+          .round(4).to_string())
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
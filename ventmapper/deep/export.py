@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argcomplete
+import argparse
+import glob
+import json
+import numpy as np
+import os
+import time
+from termcolor import colored
+
+from ventmapper.deep.backend import INFER_PRECISIONS
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+MODELS = ['vent_t1only', 'vent_t1fl', 'vent_multi']
+
+# fixed so the exported graph does not depend on the installed tf2onnx version
+ONNX_OPSET = 9
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage='%(prog)s -f [ format ] \n\n'
+                                           "Export ventricle models to portable graphs and check their parity "
+                                           "with the keras models")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-m', '--models', type=str, nargs='+', metavar='', default=MODELS, choices=MODELS,
+                          help="models to export (default: %(default)s)")
+    optional.add_argument('-f', '--format', type=str, metavar='', default='pb', choices=['pb', 'onnx'],
+                          help="graph format: pb (frozen tensorflow graph) or onnx (default: %(default)s)")
+    optional.add_argument('-p', '--precision', type=str, metavar='', default='float32',
+                          choices=INFER_PRECISIONS,
+                          help="precision of the exported weights: %s, the precisions seg_vent can run "
+                               "(default: %%(default)s)" % ', '.join(INFER_PRECISIONS))
+    optional.add_argument('-c', '--check', help="only check parity of already exported graphs",
+                          action='store_true')
+    optional.add_argument('-t', '--tol', type=float, metavar='', default=1e-3,
+                          help="maximum absolute difference of probabilities for parity (default: %(default)s)")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    return args.models, args.format, args.precision, args.check, args.tol
+
+
+def freeze_model(model):
+    """
+    Freeze a keras model into a tensorflow graph with its weights as constants
+    :param model: keras model
+    :return: frozen graph def
+    """
+    import tensorflow as tf
+    from keras import backend as K
+    from tensorflow.python.tools import optimize_for_inference_lib
+
+    session = K.get_session()
+    input_name = model.input.name.split(':')[0]
+    output_name = model.output.name.split(':')[0]
+
+    graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(),
+                                                             [output_name])
+    graph_def = optimize_for_inference_lib.optimize_for_inference(graph_def, [input_name], [output_name],
+                                                                  model.input.dtype.as_datatype_enum)
+
+    return graph_def
+
+
+def export_model(model_name, model_json, model_weights, fmt='pb', precision='float32'):
+    """
+    Export a model to a frozen tensorflow graph or an onnx graph next to its json
+    :param model_name: model name (ex: vent_t1only)
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :param fmt: 'pb' or 'onnx'
+    :param precision: precision of the exported weights
+    :return: exported graph file
+    """
+    import tensorflow as tf
+    from keras import backend as K
+    from ventmapper.deep.backend import get_artifact
+    from ventmapper.deep.predict import clear_models, get_model
+
+    # build the model in inference mode (no dropout, fixed normalization) in a fresh graph
+    clear_models()
+    K.set_learning_phase(0)
+    model = get_model(model_name, model_json, model_weights, precision)
+
+    graph_def = freeze_model(model)
+    out_file = get_artifact(model_json, fmt, precision)
+
+    if fmt == 'pb':
+        with open(out_file, 'wb') as out:
+            out.write(graph_def.SerializeToString())
+
+        meta = {'input': model.input.name, 'output': model.output.name, 'input_shape': list(model.input_shape)}
+        with open('%s.json' % out_file, 'w') as json_file:
+            json.dump(meta, json_file)
+
+    else:
+        try:
+            from tf2onnx import tfonnx
+        except ImportError:
+            raise ImportError("\n\n Please install tf2onnx to export onnx models:\n 'pip install tf2onnx'")
+
+        with tf.Graph().as_default() as graph:
+            tf.import_graph_def(graph_def, name='')
+            onnx_graph = tfonnx.process_tf_graph(graph, opset=ONNX_OPSET, input_names=[model.input.name],
+                                                 output_names=[model.output.name])
+            model_proto = onnx_graph.make_model(model_name)
+
+        with open(out_file, 'wb') as out:
+            out.write(model_proto.SerializeToString())
+
+    clear_models()
+    print("\n exported %s to %s" % (model_name, out_file))
+
+    return out_file
+
+
+def test_case_data(shape):
+    """
+    Input with brain-like structure from the bundled test case (its t1, or its probability map without one),
+    resampled to the model input and standardized within its non-zero voxels, repeated for each input channel
+    :param shape: model input shape (channels, x, y, z)
+    :return: array of shape (1, channels, x, y, z), None if the test case is missing
+    """
+    import nibabel as nib
+    from scipy import ndimage
+    from ventmapper.utils.bench import TEST_CASE_DIR
+
+    found = sorted(glob.glob(os.path.join(TEST_CASE_DIR, '*mprage.nii.gz'))) or \
+        sorted(glob.glob(os.path.join(TEST_CASE_DIR, '*pred.nii.gz')))
+    if not found:
+        return None
+
+    data = np.asanyarray(nib.load(found[0]).dataobj).astype(np.float32)
+    data = ndimage.zoom(data, [float(dim) / size for dim, size in zip(shape[1:], data.shape[:3])], order=1)
+
+    brain = data > 0
+    if brain.any():
+        data = np.where(brain, (data - data[brain].mean()) / max(data[brain].std(), 1e-6), 0)
+
+    return np.repeat(data[np.newaxis, np.newaxis], shape[0], axis=1).astype(np.float32)
+
+
+def check_parity(model_name, model_json, model_weights, fmt='pb', precision='float32', seed=0):
+    """
+    Compare predictions of an exported graph with the keras model on a random input and on the bundled test case
+    :return: list of (input, max absolute difference of probabilities, dice of thresholded predictions,
+             keras time, graph time)
+    """
+    from ventmapper.deep.predict import get_model
+
+    keras_model = get_model(model_name, model_json, model_weights, precision)
+    graph_model = get_model(model_name, model_json, model_weights, precision, backend=fmt)
+
+    shape = [dim if dim else 128 for dim in keras_model.input_shape[1:]]
+    inputs = [('noise', np.random.RandomState(seed).standard_normal([1] + shape).astype(np.float32)),
+              ('test_case', test_case_data(shape))]
+
+    results = []
+    for input_name, test_data in inputs:
+        if test_data is None:
+            print("\n no bundled test case found ... skipping its parity check")
+            continue
+
+        preds = []
+        times = []
+        for model in [keras_model, graph_model]:
+            model.predict(test_data)  # warm up
+            start = time.time()
+            preds.append(model.predict(test_data).astype(np.float32, copy=False))
+            times.append(time.time() - start)
+
+        max_diff = float(np.abs(preds[0] - preds[1]).max())
+
+        seg, ref = preds[1] > 0.5, preds[0] > 0.5
+        total = np.count_nonzero(seg) + np.count_nonzero(ref)
+        dice = 1. if total == 0 else 2. * np.count_nonzero(seg & ref) / total
+
+        results.append((input_name, max_diff, dice, times[0], times[1]))
+
+    return results
+
+
+def main(args):
+    parser = parsefn()
+    models, fmt, precision, check, tol = parse_inputs(parser, args)
+
+    from ventmapper.segment.ventmapper import get_model_files
+
+    failed = []
+    for model_name in models:
+        model_json, model_weights = get_model_files(model_name)
+
+        if not check:
+            print(colored("\n exporting %s (%s, %s)" % (model_name, fmt, precision), 'green'))
+            export_model(model_name, model_json, model_weights, fmt, precision)
+
+        for input_name, max_diff, dice, keras_time, graph_time in check_parity(model_name, model_json,
+                                                                               model_weights, fmt, precision):
+            status = 'ok' if max_diff <= tol else 'FAILED'
+            print("\n %s parity on %s: max abs diff %.2e, dice %.4f, keras %.2fs, %s %.2fs ... %s"
+                  % (model_name, input_name, max_diff, dice, keras_time, fmt, graph_time, status))
+
+            if max_diff > tol and model_name not in failed:
+                failed.append(model_name)
+
+    if failed:
+        print(colored("\n parity check failed for: %s" % ', '.join(failed), 'red'))
+        return 1
+
+    return 0
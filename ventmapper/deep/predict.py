@@ -3,11 +3,14 @@
 # coding: utf-8
 
 import os
+import threading
 import nibabel as nib
 import numpy as np
 
+from keras import backend as K
 from keras.models import load_model, model_from_json
 from keras_contrib.layers import InstanceNormalization
+from ventmapper.deep.backend import PRECISIONS, get_artifact, load_backend
 from ventmapper.deep.metrics import (dice_coefficient, dice_coefficient_loss, dice_coef, dice_coef_loss,
                                       weighted_dice_coefficient_loss, weighted_dice_coefficient)
 import warnings
@@ -17,6 +20,13 @@ warnings.simplefilter("ignore", FutureWarning)
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
 
+# process-wide registry of built models: (model name, precision, backend) -> (file mtimes, model)
+_model_registry = {}
+_session_config = None
+_num_threads = None
+
+_registry_lock = threading.RLock()
+
 
 def load_old_model_json(model_json):
     print("\n loading pre-trained model")
@@ -41,56 +51,330 @@ def load_old_model_json(model_json):
             raise error
 
 
-def get_prediction_labels(prediction, threshold=0.5, labels=None):
-    n_samples = prediction.shape[0]
-    label_arrays = []
+def get_prediction_labels(prediction, threshold=0.5, labels=None, out=None):
+    """
+    Label maps of a batch of predictions: most probable class, background where it is below threshold
+    :param prediction: array of shape (samples, classes, x, y, z)
+    :param threshold: minimum probability of a label
+    :param labels: label value of each class (default: class number starting at 1)
+    :param out: preallocated uint8 array of shape (samples, x, y, z)
+    :return: uint8 array of shape (samples, x, y, z)
+    """
+    n_classes = prediction.shape[1]
+
+    # lookup table from class number (0: background) to label value
+    lut = np.arange(n_classes + 1, dtype=np.uint8)
+    if labels:
+        lut[1:] = np.asarray(labels, dtype=np.uint8)[:n_classes]
 
-    for sample_number in range(n_samples):
-        label_data = np.argmax(prediction[sample_number], axis=0) + 1
-        label_data[np.max(prediction[sample_number], axis=0) < threshold] = 0
-        if labels:
-            for value in np.unique(label_data).tolist()[1:]:
-                label_data[label_data == value] = labels[value - 1]
-        label_arrays.append(np.array(label_data, dtype=np.uint8))
+    if out is None:
+        out = np.empty((prediction.shape[0],) + prediction.shape[2:], dtype=np.uint8)
 
-    return label_arrays
+    # running max over classes (ties keep the first class, like argmax) avoids strided reductions over axis 1
+    best = np.array(prediction[:, 0], dtype=np.float32)
+    out.fill(lut[1])
+    for c in range(1, n_classes):
+        out[prediction[:, c] > best] = lut[c + 1]
+        np.maximum(best, prediction[:, c], out=best)
+    out[best < threshold] = 0
+
+    return out
 
 
 def prediction_to_image(prediction, affine, label_map=False, threshold=0.5, labels=None):
+    return predictions_to_images(prediction[:1], [affine], label_map=label_map, threshold=threshold,
+                                 labels=labels)[0]
+
+
+def predictions_to_images(prediction, affines, label_map=False, threshold=0.5, labels=None):
+    """
+    Images of a batch of predictions, labelled all at once
+    :param prediction: array of shape (samples, classes, x, y, z)
+    :param affines: affine of each sample
+    :return: list with an image (or a list of images per class) for each sample
+    """
     if prediction.shape[1] == 1:
-        data = prediction[0, 0]
+        return [nib.Nifti1Image(prediction[i, 0], affine) for i, affine in enumerate(affines)]
 
     elif prediction.shape[1] > 1:
         if label_map:
             label_map_data = get_prediction_labels(prediction, threshold=threshold, labels=labels)
-            data = label_map_data[0]
+            return [nib.Nifti1Image(label_map_data[i], affine) for i, affine in enumerate(affines)]
         else:
-            return multi_class_prediction(prediction, affine)
-    else:
-        raise RuntimeError("Invalid prediction array shape: {0}".format(prediction.shape))
+            return [multi_class_prediction(prediction[i:i + 1], affine) for i, affine in enumerate(affines)]
 
-    return nib.Nifti1Image(data, affine)
+    raise RuntimeError("Invalid prediction array shape: {0}".format(prediction.shape))
 
 
 def multi_class_prediction(prediction, affine):
-    prediction_images = []
+    # one image per class, sharing the prediction memory
+    return [nib.Nifti1Image(prediction[0, i], affine) for i in range(prediction.shape[1])]
+
+
+def set_num_threads(num_threads):
+    """
+    Limit the number of threads used by the backend for inference
+    :param num_threads: intra-op threads (ops are run one at a time)
+    """
+    import tensorflow as tf
+    global _session_config, _num_threads
+
+    _num_threads = num_threads
+    _session_config = tf.ConfigProto(intra_op_parallelism_threads=num_threads, inter_op_parallelism_threads=1)
+    K.set_session(tf.Session(config=_session_config))
+
+
+def reset_session():
+    """
+    Clear the backend graph shared by the keras models, releasing their memory, and start a new session
+    with the same thread limits
+    """
+    import tensorflow as tf
+
+    K.clear_session()
+    if _session_config is not None:
+        K.set_session(tf.Session(config=_session_config))
+
+
+def quantize_weights(weights, precision):
+    """
+    Round weights to a reduced precision format (values are returned as float32)
+    :param weights: weight array
+    :param precision: 'bfloat16' (8 bit mantissa) or 'int8' (symmetric, per output channel for kernels)
+    :return: quantized weights
+    """
+    weights = np.asarray(weights, dtype=np.float32)
+
+    if precision == 'bfloat16':
+        # keep the upper 16 bits, rounding to nearest even
+        bits = weights.view(np.uint32).astype(np.uint64)
+        bits = (bits + 0x7FFF + ((bits >> 16) & 1)) & 0xFFFF0000
+        return bits.astype(np.uint32).view(np.float32)
+
+    elif precision == 'int8':
+        # biases and normalization parameters are kept in full precision
+        if weights.ndim < 2:
+            return weights
+        scale = np.abs(weights).reshape(-1, weights.shape[-1]).max(axis=0) / 127.
+        scale[scale == 0] = 1.
+        return (np.clip(np.round(weights / scale), -127, 127) * scale).astype(np.float32)
+
+    return weights
+
+
+def get_model(model_name, model_json, model_weights, precision='float32', backend='keras'):
+    """
+    Get a model from the process-wide registry, building it once and rebuilding only if its files change
+    :param model_name: registry key (ex: vent_t1only)
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :param precision: 'float32', 'float16' (model built in half precision),
+                      'bfloat16' or 'int8' (weights quantized, computed in float32)
+    :param backend: 'keras', or an exported graph: 'pb' (frozen tensorflow graph) or 'onnx'
+    :return: keras model with loaded weights (or exported graph runner with the same predict method)
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("unknown precision %s, choose from: %s" % (precision, ', '.join(PRECISIONS)))
+
+    if backend != 'keras':
+        graph_file = get_artifact(model_json, backend, precision)
+        key = (os.path.getmtime(graph_file) if os.path.exists(graph_file) else None,)
+    else:
+        key = (os.path.getmtime(model_json), os.path.getmtime(model_weights))
+
+    with _registry_lock:
+        entry = _model_registry.get((model_name, precision, backend))
+
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        if backend != 'keras':
+            entry = (key, load_backend(graph_file, backend, config=_session_config, num_threads=_num_threads))
+            _model_registry[(model_name, precision, backend)] = entry
+
+        else:
+            if entry is not None:
+                # the files changed: the old model is only released by clearing the graph all keras models share,
+                # the other keras models are rebuilt on their next use
+                for registry_key in [registry_key for registry_key in _model_registry if registry_key[2] == 'keras']:
+                    del _model_registry[registry_key]
+                reset_session()
+
+            with open(model_json, 'r') as json_file:
+                loaded_model_json = json_file.read()
+
+            floatx = K.floatx()
+            if precision == 'float16':
+                K.set_floatx('float16')
+            try:
+                model = load_old_model_json(loaded_model_json)
+            finally:
+                K.set_floatx(floatx)
+
+            model.load_weights(model_weights)
+            if precision in ['bfloat16', 'int8']:
+                model.set_weights([quantize_weights(weights, precision) for weights in model.get_weights()])
+
+            # build the predict function now so the model can be shared across threads
+            model._make_predict_function()
+
+            entry = (key, model)
+            _model_registry[(model_name, precision, backend)] = entry
+
+        return entry[1]
 
-    for i in range(prediction.shape[1]):
-        prediction_images.append(nib.Nifti1Image(prediction[0, i], affine))
 
-    return prediction_images
+def loaded_models():
+    """
+    List models currently held in the registry
+    :return: list of (model name, precision, backend)
+    """
+    with _registry_lock:
+        return list(_model_registry.keys())
+
+
+def clear_models(model_name=None):
+    """
+    Evict models from the registry to release memory
+    :param model_name: model to evict, in all precisions and backends (default: all models)
+    """
+    with _registry_lock:
+        for key in list(_model_registry.keys()):
+            if model_name is None or key[0] == model_name:
+                del _model_registry[key]
+
+        # all models share one backend graph, so memory is only released once none are left
+        if not _model_registry:
+            reset_session()
 
 
 def run_test_case(test_data, model_json, model_weights, affine,
-                  output_label_map=False, threshold=0.5, labels=None):
-    json_file = open(model_json, 'r')
-    loaded_model_json = json_file.read()
-    json_file.close()
-    model = load_old_model_json(loaded_model_json)
+                  output_label_map=False, threshold=0.5, labels=None, model_name=None, precision='float32',
+                  backend='keras'):
+    model = get_model(model_name if model_name is not None else model_json, model_json, model_weights, precision,
+                      backend)
+
+    prediction = model.predict(test_data).astype(np.float32, copy=False)
+
+    return prediction_to_image(prediction, affine, label_map=output_label_map, threshold=threshold,
+                               labels=labels)
+
+
+def run_test_batch(test_data, model_json, model_weights, affines,
+                   output_label_map=False, threshold=0.5, labels=None, model_name=None, precision='float32',
+                   backend='keras'):
+    """
+    Predict a batch of subjects stacked along the first axis in a single forward pass
+    :param test_data: array of shape (subjects, mods, x, y, z)
+    :param affines: affine of each subject
+    :return: list of predicted images, one per subject
+    """
+    model = get_model(model_name if model_name is not None else model_json, model_json, model_weights, precision,
+                      backend)
+
+    prediction = model.predict(test_data, batch_size=len(test_data)).astype(np.float32, copy=False)
+
+    return predictions_to_images(prediction, affines, label_map=output_label_map, threshold=threshold, labels=labels)
+
+
+def get_patch_starts(dim, patch, step):
+    """
+    Start of each patch along an axis, the last patch ending at the border
+    (steps larger than the patch are reduced to the patch, leaving no voxel uncovered)
+    """
+    if dim <= patch:
+        return [0]
+
+    starts = list(range(0, dim - patch, min(max(step, 1), patch)))
+    starts.append(dim - patch)
+
+    return starts
+
+
+def get_blend_weights(patch_shape, blend='gaussian'):
+    """
+    Weight map down-weighting patch borders when blending overlapping patches
+    :param patch_shape: patch shape
+    :param blend: 'gaussian' or 'linear'
+    :return: weight map of patch_shape
+    """
+    weights = np.ones(patch_shape, dtype=np.float32)
+
+    for ax, dim in enumerate(patch_shape):
+        center = (dim - 1) / 2.
+        dist = np.abs(np.arange(dim, dtype=np.float32) - center)
+        if blend == 'gaussian':
+            profile = np.exp(-0.5 * (dist / (dim / 8.)) ** 2)
+        else:
+            profile = 1. - dist / (center + 1.)
+        shape = [1] * len(patch_shape)
+        shape[ax] = dim
+        weights *= np.maximum(profile, 1e-3).reshape(shape)
+
+    return weights
+
+
+def predict_sliding_window(model, data, patch_shape=None, step=64, batch_size=2, blend='gaussian'):
+    """
+    Predict a volume of any size by tiling it with overlapping patches and blending their predictions
+    :param model: model (or backend) with a predict method
+    :param data: array of shape (mods, x, y, z)
+    :param patch_shape: patch shape (default: model input shape)
+    :param step: spacing between patches in voxels
+    :param batch_size: number of patches per forward pass (bounds memory use)
+    :param blend: weighting of overlapping patches, 'gaussian' or 'linear'
+    :return: prediction of shape (1, labels, x, y, z)
+    """
+    if patch_shape is None:
+        patch_shape = [dim if dim else 128 for dim in model.input_shape[2:]]
+    patch_shape = list(patch_shape)
+
+    # pad volumes smaller than a patch
+    shape = data.shape[1:]
+    pad = [(0, 0)] + [(0, max(patch - dim, 0)) for dim, patch in zip(shape, patch_shape)]
+    data = np.pad(data, pad, mode='constant')
+    padded_shape = data.shape[1:]
+
+    weights = get_blend_weights(patch_shape, blend)
+    corners = [(x, y, z) for x in get_patch_starts(padded_shape[0], patch_shape[0], step)
+               for y in get_patch_starts(padded_shape[1], patch_shape[1], step)
+               for z in get_patch_starts(padded_shape[2], patch_shape[2], step)]
+
+    prediction = None
+    norm = np.zeros(padded_shape, dtype=np.float32)
+
+    for b in range(0, len(corners), batch_size):
+        batch_corners = corners[b:b + batch_size]
+        slices = [tuple(slice(c, c + patch) for c, patch in zip(corner, patch_shape)) for corner in batch_corners]
+
+        batch = np.stack([data[(slice(None),) + sl] for sl in slices])
+        batch_pred = model.predict(batch, batch_size=len(batch))
+
+        if prediction is None:
+            prediction = np.zeros((batch_pred.shape[1],) + tuple(padded_shape), dtype=np.float32)
+
+        for sl, patch_pred in zip(slices, batch_pred):
+            prediction[(slice(None),) + sl] += patch_pred * weights
+            norm[sl] += weights
+
+    prediction /= norm
+    prediction = prediction[(slice(None),) + tuple(slice(0, dim) for dim in shape)]
+
+    return prediction[np.newaxis]
+
 
-    model.load_weights(model_weights)
+def run_sliding_window(test_data, model_json, model_weights, affine, output_label_map=False, threshold=0.5,
+                       labels=None, model_name=None, step=64, batch_size=2, blend='gaussian', precision='float32',
+                       backend='keras'):
+    """
+    Predict a subject at its native resolution with overlapping patches
+    :param test_data: array of shape (mods, x, y, z)
+    :return: predicted image
+    """
+    model = get_model(model_name if model_name is not None else model_json, model_json, model_weights, precision,
+                      backend)
 
-    prediction = model.predict(test_data)
+    prediction = predict_sliding_window(model, test_data, step=step, batch_size=batch_size, blend=blend)
 
     return prediction_to_image(prediction, affine, label_map=output_label_map, threshold=threshold,
                                labels=labels)
@@ -3,12 +3,14 @@
 # coding: utf-8 
 
 import os
-import subprocess
 import sys
 import ventmapper
 from pathlib import Path
 from PyQt5 import QtGui, QtCore, QtWidgets
 
+from ventmapper.cli import get_subparser
+from ventmapper.utils import gui_jobs, gui_options
+
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
 
 
@@ -43,10 +45,15 @@ class HorzTabWidget(QtWidgets.QTabWidget):
 
 
 def capture_help_fn(fn_name):
-    proc = subprocess.Popen("ventmapper %s -h" % fn_name, shell=True, stdout=subprocess.PIPE)
-    out = proc.communicate()[0]
-    out_str = out.decode("utf-8")
-    return out_str
+    # parsers are built in-process once and cached by the cli
+    return get_subparser(fn_name).format_help()
+
+
+# option windows open (a window is closed when garbage collected)
+open_windows = []
+
+# queue running the jobs submitted from the option windows (created with the application)
+job_queue = None
 
 
 modules = ['Conversion', 'Pre-Process', 'Segmentation', 'QC', 'Statistics',]
@@ -58,7 +65,7 @@ nested_dict = {
             0: {
                 'name': 'Convert Filetype',
                 'script': 'filetype',
-                'opts': '-t filetype -v in_img -f out',
+                'vols': ['in_img'],
                 'helpmsg': 'Converts file to nifti GZ'
             },
         }
@@ -69,7 +76,7 @@ nested_dict = {
             0: {
                 'name': 'Bias Correction',
                 'script': 'bias_corr',
-                'opts': '-t bias_corr -v in_img -f out',
+                'vols': ['in_img'],
                 'helpmsg': 'Bias correct using N4'
             },
         }
@@ -80,7 +87,8 @@ nested_dict = {
             0: {
                 'name': 'Ventricular Segmentation',
                 'script': 'seg_vent',
-                'opts': '-t seg_vent -v t1w t2 flair mask -f out -c force',
+                'vols': ['t1w', 't2w', 'flair', 'mask', 'subj_list'],
+                'dirs': ['subj'],
                 'helpmsg': 'Segments the ventricular system using a trained CNN'
             },
         }
@@ -91,7 +99,7 @@ nested_dict = {
             0: {
                 'name': 'Segmentation QC',
                 'script': 'seg_qc',
-                'opts': '-t seg_qc -v img seg -f out gap min alpha tile direct flip roi',
+                'vols': ['img', 'seg'],
                 'helpmsg': 'Creates tiled mosaic of segmentation overlaid on structural image'
             }
         }
@@ -102,35 +110,61 @@ nested_dict = {
             0: {
                 'name': 'Ventricular Sytem Volume Summary',
                 'script': 'stats_vent',
-                'opts': '-t stats_vent -v in_dir -f out_csv',
+                'dirs': ['in_dir'],
                 'helpmsg': 'Generates volumetric summary of ventricular segmentations'
             },
+            1: {
+                'name': 'Ventricular Geometry Summary',
+                'script': 'stats_geom',
+                'dirs': ['in_dir'],
+                'helpmsg': 'Generates geometry summary of left and right ventricles'
+            },
         }
     },
 }
 
 
-def fun_button(nested_dictionary, module, btn_num, hyper_home):
+def fun_button(nested_dictionary, module, btn_num):
     fun_name = nested_dictionary[module]['functions'][btn_num]['name']
     btn = QtWidgets.QPushButton(fun_name)
-    btn.clicked.connect(lambda: run_func(nested_dictionary, module, btn_num, hyper_home))
+    btn.clicked.connect(lambda: run_func(nested_dictionary, module, btn_num))
     btn.setToolTip(nested_dict[module]['functions'][btn_num]['helpmsg'])
 
     return btn
 
 
-def run_func(nested_dictionary, module, btnnum, hyper_home):
-    opts = nested_dictionary[module]['functions'][btnnum]['opts']
-    script_name = nested_dictionary[module]['functions'][btnnum]['script']
+def run_func(nested_dictionary, module, btnnum):
+    function = nested_dictionary[module]['functions'][btnnum]
+    script_name = function['script']
     help_str = capture_help_fn(fn_name=script_name)
 
-    subprocess.Popen('%s/utils/gui_options.py %s -hf "%s"' % (hyper_home, opts, help_str), shell=True,
-                     stdin=None, stdout=None, stderr=None, close_fds=True)
+    # option widgets from the subcommand parser
+    vols, dirs, fields, checks, tooltips = gui_options.parser_fields(get_subparser(script_name),
+                                                                     function.get('vols'), function.get('dirs'))
+
+    def run_cmd(cmd):
+        # the option window stays open to queue more subjects
+        job_queue.submit(script_name, cmd)
+        job_queue.show()
+        job_queue.raise_()
+
+    menu, linedits, labels = gui_options.OptsMenu(title=script_name.replace('_', ' ').upper(), vols=vols,
+                                                  dirs=dirs, fields=fields, checks=checks,
+                                                  helpfun=help_str.replace('\n', '<br>'), tooltips=tooltips,
+                                                  on_run=run_cmd)
+
+    open_windows[:] = [window for window in open_windows if window.isVisible()] + [menu]
+    menu.show()
 
 
 def main():
+    global job_queue
+
     app = QtWidgets.QApplication(sys.argv)
 
+    job_queue = gui_jobs.JobQueue()
+    app.aboutToQuit.connect(job_queue.shutdown)
+
     mainwidget = QtWidgets.QWidget()
     mainwidget.resize(150, 550)
 
@@ -148,7 +182,6 @@ def main():
     vbox = QtWidgets.QVBoxLayout(mainwidget)
 
     gui_file = os.path.realpath(__file__)
-    hyper_home = Path(gui_file).parents[0]
     hyper_mother = Path(gui_file).parents[1]
 
     pic = QtWidgets.QLabel()
@@ -169,7 +202,7 @@ def main():
         widget.layout = QtWidgets.QVBoxLayout()
 
         for b in range(len(nested_dict[mod]['functions'])):
-            btn = fun_button(nested_dict, mod, b, hyper_home)
+            btn = fun_button(nested_dict, mod, b)
             widget.layout.addWidget(btn)
 
         widget.setLayout(widget.layout)
@@ -179,6 +212,11 @@ def main():
 
     vbox.addWidget(tabs)
 
+    jobs_btn = QtWidgets.QPushButton('Jobs')
+    jobs_btn.setToolTip('Show the queued and running jobs')
+    jobs_btn.clicked.connect(job_queue.show)
+    vbox.addWidget(jobs_btn)
+
     mainwidget.setLayout(vbox)
     mainwidget.show()
 
@@ -8,9 +8,8 @@ import sys
 import multiprocessing
 import os
 from datetime import datetime
-from ventmapper.utils import endstatement
+from ventmapper.utils import endstatement, trace
 
-from nipype.interfaces.ants import N4BiasFieldCorrection
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
 
@@ -74,6 +73,8 @@ def main(args):
 
     else:
 
+        from nipype.interfaces.ants import N4BiasFieldCorrection
+
         start_time = datetime.now()
 
         n4 = N4BiasFieldCorrection()
@@ -98,7 +99,8 @@ def main(args):
 
         print("\n bias field correcting %s " % in_img)
         n4.terminal_output = "none"
-        n4.run()
+        with trace.tracing(os.path.dirname(os.path.abspath(in_img)), command='bias_corr'), trace.stage('n4'):
+            n4.run()
 
         endstatement.main('Bias field correction', '%s' % (datetime.now() - start_time))
 
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import nibabel as nib
+import numpy as np
+
+from ventmapper.preprocess.standardize import local_window_standardize
+
+
+def mask_data(data, mask):
+    """
+    Skull strip image data (equivalent of c3d img mask -multiply)
+    :param data: image array
+    :param mask: brain mask array
+    :return: masked array (float32)
+    """
+    return np.multiply(data, mask > 0, dtype=np.float32)
+
+
+def standardize_data(data, mask, radius=25):
+    """
+    Normalize intensities by the mean and std of brain voxels in a local window
+    (numpy version of c3d img mask -nlw 25x25x25 mask -times -replace nan 0, see local_window_standardize for
+    where it can differ from c3d)
+    :param data: image array
+    :param mask: brain mask array
+    :param radius: window radius in voxels (window size is 2 * radius + 1)
+    :return: standardized array (float32), zero outside the mask
+    """
+    return local_window_standardize(data, mask, radius)
+
+
+def get_bbox(data, voxels=1):
+    """
+    Bounding box of non-zero voxels with a margin (equivalent of c3d -trim)
+    :param data: image array
+    :param voxels: margin in voxels
+    :return: tuple of slices
+    """
+    bbox = []
+    for ax in range(data.ndim):
+        nonzero = np.flatnonzero(np.any(data, axis=tuple(a for a in range(data.ndim) if a != ax)))
+        if nonzero.size == 0:
+            return tuple(slice(0, dim) for dim in data.shape)
+        bbox.append(slice(max(int(nonzero[0]) - voxels, 0), min(int(nonzero[-1]) + voxels + 1, data.shape[ax])))
+
+    return tuple(bbox)
+
+
+def bbox_affine(affine, bbox):
+    """
+    Affine of an image cropped to a bounding box
+    :param affine: image affine
+    :param bbox: tuple of slices
+    :return: cropped affine
+    """
+    crop_affine = np.copy(affine)
+    crop_affine[:3, 3] = affine[:3, :3].dot([sl.start for sl in bbox]) + affine[:3, 3]
+
+    return crop_affine
+
+
+def crop_img(data, affine, bbox):
+    """
+    Crop image data to a bounding box
+    :param data: image array
+    :param affine: image affine
+    :param bbox: tuple of slices
+    :return: cropped nifti image
+    """
+    return nib.Nifti1Image(data[bbox], bbox_affine(affine, bbox))
+
+
+def crop_like(data, affine, ref_shape, ref_affine, bbox):
+    """
+    Crop image data like a cropped reference (equivalent of c3d ref_crop img -int 1 -reslice-identity)
+    :param data: image array
+    :param affine: image affine
+    :param ref_shape: shape of the uncropped reference
+    :param ref_affine: affine of the uncropped reference
+    :param bbox: bounding box used to crop the reference
+    :return: cropped nifti image
+    """
+    if data.shape == tuple(ref_shape) and np.allclose(affine, ref_affine):
+        return crop_img(data, affine, bbox)
+
+    from nilearn.image import resample_img
+
+    # image is not on the reference grid, reslice it
+    return resample_img(nib.Nifti1Image(data, affine), target_affine=bbox_affine(ref_affine, bbox),
+                        target_shape=[sl.stop - sl.start for sl in bbox], interpolation='linear')
+
+
+def fov_bbox(img, ref_img, voxels=1):
+    """
+    Bounding box of an image's field of view on the grid of a reference
+    :param img: nifti image (ex: prediction on a cropped and resampled grid)
+    :param ref_img: reference nifti image
+    :param voxels: margin in voxels
+    :return: tuple of slices of the reference grid
+    """
+    corners = np.array([[x, y, z, 1] for x in (-0.5, img.shape[0] - 0.5) for y in (-0.5, img.shape[1] - 0.5)
+                        for z in (-0.5, img.shape[2] - 0.5)]).T
+    ref_corners = np.linalg.inv(ref_img.affine).dot(img.affine).dot(corners)[:3]
+
+    return tuple(slice(max(int(np.floor(ref_corners[ax].min())) - voxels, 0),
+                       min(int(np.ceil(ref_corners[ax].max())) + voxels + 1, ref_img.shape[ax]))
+                 for ax in range(3))
+
+
+def resample_back(img, ref_img, threshold=0.5, prob=True):
+    """
+    Resample an image to a reference within its field of view only and threshold it
+    (equivalent of resample_to_img followed by math_img 'img > threshold', outside voxels are zero)
+    :param img: nifti image (ex: probability map)
+    :param ref_img: reference nifti image
+    :param threshold: threshold of the resampled image
+    :param prob: also return the resampled image before thresholding
+    :return: thresholded image (uint8), resampled image (float32, None if prob is False)
+    """
+    bbox = fov_bbox(img, ref_img)
+    label_data = np.zeros(ref_img.shape[:3], dtype=np.uint8)
+
+    if any(sl.stop <= sl.start for sl in bbox):
+        # no overlap with the reference
+        prob_img = nib.Nifti1Image(label_data.astype(np.float32), ref_img.affine) if prob else None
+        return nib.Nifti1Image(label_data, ref_img.affine), prob_img
+
+    from nilearn.image import resample_img
+
+    res = resample_img(img, target_affine=bbox_affine(ref_img.affine, bbox),
+                       target_shape=[sl.stop - sl.start for sl in bbox], interpolation='continuous')
+    res_data = np.asanyarray(res.dataobj)
+
+    label_data[bbox] = res_data > threshold
+    label_img = nib.Nifti1Image(label_data, ref_img.affine)
+
+    prob_img = None
+    if prob:
+        prob_data = np.zeros(ref_img.shape[:3], dtype=np.float32)
+        prob_data[bbox] = res_data
+        prob_img = nib.Nifti1Image(prob_data, ref_img.affine)
+
+    return label_img, prob_img
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import nibabel as nib
+from nibabel.orientations import axcodes2ornt, io_orientation, ornt_transform
+
+# c3d/itk orientation letters name the side each axis starts from, nibabel axis codes the side it points to
+OPPOSITE = {'R': 'L', 'L': 'R', 'A': 'P', 'P': 'A', 'S': 'I', 'I': 'S'}
+
+
+def get_orient(img):
+    """
+    Get the orientation of an image from its affine, as a c3d orientation tag (ex: RPI)
+    :param img: nibabel image
+    :return: orientation tag
+    """
+    return ''.join(OPPOSITE[code] for code in nib.aff2axcodes(img.affine))
+
+
+def reorient(img, orient_tag):
+    """
+    Re-orient image to a c3d orientation tag by flipping / transposing axes (equivalent of c3d -orient)
+    :param img: nibabel image
+    :param orient_tag: target orientation tag (ex: RPI)
+    :return: re-oriented image (data is a view of the input where possible)
+    """
+    target = axcodes2ornt(tuple(OPPOSITE[code] for code in orient_tag))
+
+    return img.as_reoriented(ornt_transform(io_orientation(img.affine), target))
+
+
+def std_orient(img, r_orient='RPI', l_orient='LPI'):
+    """
+    Re-orient image to standard orientation (RPI or LPI) if needed
+    :param img: nibabel image
+    :param r_orient: right standard orientation
+    :param l_orient: left standard orientation
+    :return: image in standard orientation, original orientation tag (None if already in standard orientation)
+    """
+    img_ort = get_orient(img)
+
+    if img_ort in [r_orient, l_orient]:
+        return img, None
+
+    orient_tag = r_orient if 'R' in img_ort else l_orient
+    print("\n Warning: input image is not in RPI or LPI orientation.. "
+          "\n re-orienting image from %s to %s (please make sure the header is correct)" % (img_ort, orient_tag))
+
+    return reorient(img, orient_tag), img_ort
@@ -6,8 +6,7 @@ import os
 import argcomplete
 import argparse
 import sys
-from nipype.interfaces.ants.visualization import ConvertScalarImageToRGB, CreateTiledMosaic
-from nipype.interfaces.c3 import C3d
+from ventmapper.utils import trace
 import warnings
 
 warnings.simplefilter("ignore", FutureWarning)
@@ -76,6 +75,15 @@ def main(args):
     parser = parsefn()
     subj_dir, img, seg, gap, tile, alpha, ax, roi, flip, min_sl, out = parse_inputs(parser, args)
 
+    with trace.tracing(subj_dir, command='seg_qc'):
+        create_mosaic(subj_dir, img, seg, gap, tile, alpha, ax, roi, flip, min_sl, out)
+
+
+def create_mosaic(subj_dir, img, seg, gap, tile, alpha, ax, roi, flip, min_sl, out):
+    # nipype is only loaded when a mosaic is made (the gui builds this module's parser)
+    from nipype.interfaces.ants.visualization import ConvertScalarImageToRGB, CreateTiledMosaic
+    from nipype.interfaces.c3 import C3d
+
     # pred preprocess dir
     pred_dir = '%s/pred_process' % os.path.abspath(subj_dir)
     if not os.path.exists(pred_dir):
@@ -92,7 +100,8 @@ def main(args):
         seg_trim_file = "%s/%s_trim_mosaic.nii.gz" % (pred_dir, os.path.basename(seg).split('.')[0])
         # seg_trim_file = "seg_trim.nii.gz"
         c3.inputs.out_file = seg_trim_file
-        c3.run()
+        with trace.stage('trim_seg'):
+            c3.run()
 
         # trim struct like seg
         c3.inputs.in_file = seg_trim_file
@@ -100,7 +109,8 @@ def main(args):
         struct_trim_file = "%s/%s_trim_mosaic.nii.gz" % (pred_dir, os.path.basename(img).split('.')[0])
         # struct_trim_file = "struct_trim.nii.gz"
         c3.inputs.out_file = struct_trim_file
-        c3.run()
+        with trace.stage('trim_struct'):
+            c3.run()
 
         # create rgb image from seg
         converter = ConvertScalarImageToRGB()
@@ -112,7 +122,8 @@ def main(args):
         converter.inputs.maximum_input = 10
         out_rgb = "%s/%s_trim_rgb.nii.gz" % (pred_dir, os.path.basename(seg).split('.')[0])
         converter.inputs.output_image = out_rgb
-        converter.run()
+        with trace.stage('seg_rgb'):
+            converter.run()
 
         mosaic_slicer.inputs.rgb_image = out_rgb
         mosaic_slicer.inputs.mask_image = seg_trim_file
@@ -127,7 +138,8 @@ def main(args):
     c3.inputs.in_file = struct_trim_file
     c3.inputs.args = "-stretch 2% 98% 0 255 -clip 0 255"
     c3.inputs.out_file = struct_trim_file
-    c3.run()
+    with trace.stage('stretch'):
+        c3.run()
 
     # slices to show
     if gap == 1:
@@ -150,7 +162,8 @@ def main(args):
     mosaic_slicer.inputs.slices = slices
     mosaic_slicer.inputs.flip_slice = flip
     mosaic_slicer.terminal_output = "none"
-    mosaic_slicer.run()
+    with trace.stage('mosaic'):
+        mosaic_slicer.run()
 
 
 if __name__ == "__main__":
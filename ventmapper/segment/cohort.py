@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argcomplete
+import argparse
+import contextlib
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from termcolor import colored
+
+from ventmapper.segment.ventmapper import add_seg_opts, get_seg_opts, parse_cohort_inputs, seg_subj, \
+    get_model_name, get_model_files, get_pred_dir, get_prediction_files, preprocess_subj, lookup_pred, predict_subjs, \
+    store_pred, save_prediction
+from ventmapper.utils import endstatement, trace
+from ventmapper.utils.stage_cache import StageCache
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+# thread pools of numpy (blas), itk (c3d / ants) and openmp sized by each worker's cpu share
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage='%(prog)s -i [ in_dir ] \n\n'
+                                           "Segment ventricles of a cohort with parallel workers")
+
+    required = parser.add_argument_group('required arguments')
+
+    required.add_argument('-i', '--in_dir', type=str, required=True, metavar='',
+                          help="directory of subjects or text file with one subject dir per line")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-c', '--cpus', type=int, metavar='', default=multiprocessing.cpu_count(),
+                          help="total number of cpus to use (default: %(default)s)")
+    optional.add_argument('-w', '--workers', type=int, metavar='', default=None,
+                          help="number of subjects segmented concurrently (default: cpus / 4)")
+    optional.add_argument('-md', '--mode', type=str, metavar='', default='parallel',
+                          choices=['parallel', 'pipeline'],
+                          help="parallel: workers segment whole subjects, pipeline: workers preprocess subjects "
+                               "for a single inference stage holding the model, followed by post-processing "
+                               "workers (default: %(default)s)")
+    optional.add_argument('-q', '--queue_size', type=int, metavar='', default=2,
+                          help="pipeline mode: preprocessed subjects waiting for inference (default: %(default)s)")
+    optional.add_argument('-pw', '--post_workers', type=int, metavar='', default=1,
+                          help="pipeline mode: number of post-processing workers (default: %(default)s)")
+    add_seg_opts(optional)
+    optional.add_argument('-r', '--report', type=str, metavar='', default=None,
+                          help="output csv with the status of each subject")
+    optional.add_argument('-f', '--force', help="overwrite existing segmentations", action='store_true')
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    cpus = max(args.cpus, 1)
+    workers = args.workers if args.workers is not None else max(cpus // 4, 1)
+    workers = min(max(workers, 1), cpus)
+
+    pipe_opts = dict(queue_size=max(args.queue_size, 1), post_workers=max(args.post_workers, 1))
+
+    return args.in_dir, cpus, workers, args.mode, pipe_opts, get_seg_opts(args), args.report, \
+        True if args.force else False
+
+
+@contextlib.contextmanager
+def subj_log(subj_dir):
+    """
+    Redirect output to the subject's cohort log
+    """
+    log_dir = os.path.join(subj_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+
+    with open(os.path.join(log_dir, 'seg_cohort.log'), 'a') as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        yield
+
+
+@contextlib.contextmanager
+def thread_limits(num_threads):
+    """
+    Set the thread limits inherited by processes started in this context
+    """
+    env = {env_var: os.environ.get(env_var) for env_var in THREAD_ENV_VARS}
+    os.environ.update({env_var: str(num_threads) for env_var in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for env_var, value in env.items():
+            if value is None:
+                os.environ.pop(env_var)
+            else:
+                os.environ[env_var] = value
+
+
+class WorkerPool(object):
+    """ Spawned worker processes limited to num_threads threads each. When a worker dies (ex: killed when out of
+    memory), its pool fails the jobs it was running and is replaced by a new one for the following jobs
+    """
+    # the thread limits are set in the environment, which the workers inherit when they start
+    env_lock = threading.Lock()
+
+    def __init__(self, workers, num_threads, initializer=None, initargs=()):
+        self.workers = workers
+        self.num_threads = num_threads
+        self.initializer = initializer
+        self.initargs = initargs
+        self.pool = None
+
+    def start(self):
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=self.initializer, initargs=self.initargs)
+
+    def submit(self, fn, *args):
+        # workers are started on submission
+        with WorkerPool.env_lock, thread_limits(self.num_threads):
+            if self.pool is None:
+                self.start()
+            try:
+                return self.pool.submit(fn, *args)
+            except BrokenProcessPool:
+                print("\n a worker process died, starting new workers")
+                self.pool.shutdown(wait=False)
+                self.start()
+                return self.pool.submit(fn, *args)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+def worker_error(error):
+    """
+    Message of a job that raised in its worker, or whose worker died
+    """
+    if isinstance(error, BrokenProcessPool):
+        return 'worker process died (ex: killed when out of memory)'
+    return str(error)
+
+
+def init_worker(num_threads):
+    """
+    Limit the inference threads of a worker
+    :param num_threads: threads available to this worker
+    """
+    from ventmapper.deep.predict import set_num_threads
+    set_num_threads(num_threads)
+
+
+def seg_worker(subj_inputs, seg_opts):
+    """
+    Segment a subject, logging its output to the subject's logs dir
+    :return: subject, status, prediction or error, elapsed time
+    """
+    subj_dir, subj = subj_inputs[:2]
+    start_time = datetime.now()
+
+    with subj_log(subj_dir):
+        try:
+            prediction = seg_subj(*subj_inputs, **seg_opts)
+            status, message = 'done', prediction
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            status, message = 'failed', traceback.format_exc().strip().splitlines()[-1]
+
+    return subj, status, message, (datetime.now() - start_time).total_seconds()
+
+
+def run_cohort(cohort, cpus, workers, seg_opts):
+    """
+    Segment subjects concurrently, continuing past failures
+    :param cohort: list of subject inputs (subj_dir, subj, t1, fl, t2, mask, out, force)
+    :param cpus: total cpu budget
+    :param workers: number of worker processes
+    :param seg_opts: segmentation pipeline options
+    :return: list of (subject, status, prediction or error, elapsed seconds)
+    """
+    num_threads = max(cpus // workers, 1)
+    print(colored("\n segmenting %d subjects with %d workers x %d threads" % (len(cohort), workers, num_threads),
+                  'green'))
+
+    # spawned workers inherit the thread limits, import the models once and keep them warm for all their subjects.
+    # only as many subjects as workers are submitted: a dying worker fails the subjects it was running, not the
+    # ones waiting
+    results = [None] * len(cohort)
+    pending = list(range(len(cohort)))
+    running = {}
+    start_times = {}
+
+    with WorkerPool(workers, num_threads, initializer=init_worker, initargs=(num_threads,)) as pool:
+        while pending or running:
+            while pending and len(running) < workers:
+                s = pending.pop(0)
+                start_times[s] = time.time()
+                running[pool.submit(seg_worker, cohort[s], seg_opts)] = s
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for job in finished:
+                s = running.pop(job)
+                try:
+                    result = job.result()
+                except Exception as error:
+                    result = (cohort[s][1], 'failed', worker_error(error), time.time() - start_times[s])
+                results[s] = result
+                print(" [%d/%d] %s %s (%.1fs) %s" % (len(cohort) - len(pending) - len(running), len(cohort),
+                                                     result[0], result[1], result[3],
+                                                     '' if result[1] == 'done' else result[2]))
+
+    return results
+
+
+def preprocess_worker(s, subj_inputs, engine, use_cache, pred_shape):
+    """
+    Preprocess a subject into test data (pipeline mode), logging its output to the subject's logs dir
+    :return: subject index, status, (model name, test data, affine, t1 image, t1 orientation, trace run) or error
+    """
+    subj_dir, subj, t1, fl, t2, mask, out, force = subj_inputs
+
+    with subj_log(subj_dir):
+        try:
+            test_seqs, training_mods, model_name = get_model_name(t1, fl, t2)
+            cache = StageCache(get_pred_dir(subj_dir), enabled=use_cache)
+            with trace.tracing(subj_dir, subj, 'seg_vent') as tracer, trace.stage('preprocess'):
+                test_data, res_affine, t1_img, t1_orient = preprocess_subj(subj_dir, t1, test_seqs, training_mods,
+                                                                           mask, pred_shape, engine=engine,
+                                                                           cache=cache)
+            return s, 'done', (model_name, test_data, res_affine, t1_img, t1_orient, tracer.run)
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            return s, 'failed', traceback.format_exc().strip().splitlines()[-1]
+
+
+def postprocess_worker(subj_inputs, pred, t1_img, t1_orient, model_name, use_cache, save_prob, run=None):
+    """
+    Resample a prediction back to t1 space, save it and generate its qc mosaic (pipeline mode)
+    :return: status, prediction or error
+    """
+    subj_dir, subj, t1, fl, t2, mask, out, force = subj_inputs
+
+    with subj_log(subj_dir):
+        try:
+            prediction = get_prediction_files(subj_dir, subj, out)
+            cache = StageCache(get_pred_dir(subj_dir), enabled=use_cache)
+            with trace.tracing(subj_dir, subj, 'seg_vent', run):
+                save_prediction(pred, t1_img, subj_dir, subj, t1, model_name, prediction, t1_orient, cache,
+                                save_prob)
+            return 'done', prediction
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            return 'failed', traceback.format_exc().strip().splitlines()[-1]
+
+
+def infer_subj(subj_inputs, model_name, test_data, res_affine, infer_opts, use_cache, run=None):
+    """
+    Predict a preprocessed subject with the models held by this process, reusing cached predictions
+    """
+    subj_dir, subj = subj_inputs[:2]
+    model_json, model_weights = get_model_files(model_name)
+    cache = StageCache(get_pred_dir(subj_dir), enabled=use_cache)
+
+    with trace.tracing(subj_dir, subj, 'seg_vent', run), trace.stage('inference', model=model_name) as record:
+        pred, key, pred_file = lookup_pred(cache, subj, model_name, model_json, model_weights, test_data,
+                                           res_affine, infer_opts)
+        record['cached'] = pred is not None
+        if pred is None:
+            pred = predict_subjs([test_data], [res_affine], model_name, model_json, model_weights, infer_opts)[0]
+            store_pred(cache, key, pred, pred_file)
+
+    return pred
+
+
+def run_pipeline(cohort, cpus, workers, seg_opts, queue_size=2, post_workers=1):
+    """
+    Segment subjects in three overlapping stages: preprocessing workers feed a bounded queue of test data
+    to inference in this process, which hands predictions to post-processing workers
+    :param cohort: list of subject inputs (subj_dir, subj, t1, fl, t2, mask, out, force)
+    :param cpus: total cpu budget
+    :param workers: number of preprocessing processes
+    :param seg_opts: segmentation pipeline options
+    :param queue_size: preprocessed subjects waiting for inference
+    :param post_workers: number of post-processing processes
+    :return: list of (subject, status, prediction or error, elapsed seconds)
+    """
+    from ventmapper.deep.predict import set_num_threads
+
+    engine, use_cache, infer_opts = seg_opts['engine'], seg_opts['use_cache'], seg_opts['infer_opts']
+    save_prob = seg_opts['save_prob']
+    pred_shape = None if infer_opts.get('patch_step') else [128, 128, 128]
+
+    # the stages run concurrently: half of the budget is reserved for inference, the pools share the rest
+    num_threads = max((cpus - max(cpus // 2, 1)) // (workers + post_workers), 1)
+    infer_threads = max(cpus - num_threads * (workers + post_workers), 1)
+    print(colored("\n segmenting %d subjects with %d preprocessing workers, 1 inference stage (%d threads) and "
+                  "%d post-processing workers (%d threads each)" % (len(cohort), workers, infer_threads,
+                                                                    post_workers, num_threads), 'green'))
+
+    pre_pool = WorkerPool(workers, num_threads)
+    post_pool = WorkerPool(post_workers, num_threads)
+
+    set_num_threads(infer_threads)
+
+    ready = queue.Queue()
+    to_post = queue.Queue()
+    # preprocessed test data held in memory is bounded by the subjects being preprocessed or waiting
+    slots = threading.BoundedSemaphore(workers + queue_size)
+    # only as many subjects as workers are submitted to each pool: a dying worker fails the subjects it was running,
+    # not the ones waiting
+    pre_running = threading.BoundedSemaphore(workers)
+    post_running = threading.BoundedSemaphore(post_workers)
+    start_times = {}
+    results = [None] * len(cohort)
+
+    def preprocessed(s, job):
+        pre_running.release()
+        try:
+            ready.put(job.result())
+        except Exception as error:
+            ready.put((s, 'failed', worker_error(error)))
+
+    def postprocessed(s, job):
+        try:
+            status, message = job.result()
+        except Exception as error:
+            status, message = 'failed', worker_error(error)
+        results[s] = (cohort[s][1], status, message, time.time() - start_times[s])
+        post_running.release()
+
+    def feed():
+        for s, subj_inputs in enumerate(cohort):
+            slots.acquire()
+            pre_running.acquire()
+            start_times[s] = time.time()
+            job = pre_pool.submit(preprocess_worker, s, subj_inputs, engine, use_cache, pred_shape)
+            job.add_done_callback(lambda job, s=s: preprocessed(s, job))
+
+    def post():
+        for s, post_args in iter(to_post.get, None):
+            post_running.acquire()
+            job = post_pool.submit(postprocess_worker, *post_args)
+            job.add_done_callback(lambda job, s=s: postprocessed(s, job))
+
+        # wait for the last subjects
+        for _ in range(post_workers):
+            post_running.acquire()
+
+    with pre_pool, post_pool:
+        feeder = threading.Thread(target=feed, daemon=True)
+        poster = threading.Thread(target=post, daemon=True)
+        feeder.start()
+        poster.start()
+
+        for _ in range(len(cohort)):
+            s, status, payload = ready.get()
+            slots.release()
+            subj_inputs = cohort[s]
+
+            if status == 'done':
+                model_name, test_data, res_affine, t1_img, t1_orient, run = payload
+                print("\n inference: %s" % subj_inputs[1])
+                try:
+                    pred = infer_subj(subj_inputs, model_name, test_data, res_affine, infer_opts, use_cache, run)
+                except Exception:
+                    traceback.print_exc()
+                    status, payload = 'failed', traceback.format_exc().strip().splitlines()[-1]
+                else:
+                    to_post.put((s, (subj_inputs, pred, t1_img, t1_orient, model_name, use_cache, save_prob, run)))
+                del test_data
+
+            if status != 'done':
+                results[s] = (subj_inputs[1], status, payload, time.time() - start_times[s])
+
+        to_post.put(None)
+        poster.join()
+        feeder.join()
+
+    for s, result in enumerate(results):
+        print(" [%d/%d] %s %s (%.1fs) %s" % (s + 1, len(cohort), result[0], result[1], result[3],
+                                             '' if result[1] == 'done' else result[2]))
+
+    return results
+
+
+def main(args):
+    parser = parsefn()
+    in_dir, cpus, workers, mode, pipe_opts, seg_opts, report, force = parse_inputs(parser, args)
+
+    start_time = datetime.now()
+
+    cohort = parse_cohort_inputs(in_dir, force)
+    if not cohort:
+        results = []
+    elif mode == 'pipeline':
+        results = run_pipeline(cohort, cpus, workers, seg_opts, **pipe_opts)
+    else:
+        results = run_cohort(cohort, cpus, workers, seg_opts)
+
+    failed = [result for result in results if result[1] != 'done']
+    print("\n %d subjects segmented, %d failed" % (len(results) - len(failed), len(failed)))
+    for subj, status, message, elapsed in failed:
+        print("  %s: %s" % (subj, message))
+
+    if report is not None:
+        import pandas as pd
+        df = pd.DataFrame(results, columns=['Subjects', 'Status', 'Output', 'Seconds'])
+        df.to_csv(report, index=False)
+
+    endstatement.main('Cohort ventricle segmentation', '%s' % (datetime.now() - start_time))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
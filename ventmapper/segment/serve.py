@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argcomplete
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import traceback
+from termcolor import colored
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'ventmapper-%s.sock' % os.getuid())
+
+# seg_vent options holding paths, made absolute by the client since the daemon runs in its own cwd
+PATH_OPTS = ['subj', 'flair', 't1w', 't2w', 'mask', 'out', 'subj_list']
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage='%(prog)s -sk [ socket ] \n\n'
+                                           "Serve ventricle segmentations from a local daemon with warm models")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-sk', '--socket', type=str, metavar='', default=DEFAULT_SOCKET,
+                          help="unix socket to listen on (default: %(default)s)")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    return args.socket
+
+
+def send_request(socket_path, request):
+    """
+    Send a request to the daemon and wait for its response
+    :param socket_path: unix socket the daemon listens on
+    :param request: json serializable dict
+    :return: response dict
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+        with client.makefile('r', encoding='utf-8') as response:
+            return json.loads(response.readline())
+
+
+def seg_vent_client(args, socket_path):
+    """
+    Run seg_vent through the daemon
+    :param args: parsed seg_vent arguments
+    :param socket_path: unix socket the daemon listens on
+    :return: prediction(s)
+    """
+    opts = {k: v for k, v in vars(args).items() if k not in ['func', 'server']}
+    for opt in PATH_OPTS:
+        if opts.get(opt):
+            opts[opt] = os.path.abspath(opts[opt])
+
+    print("\n sending segmentation request to %s" % socket_path)
+    response = send_request(socket_path, {'cmd': 'seg_vent', 'args': opts})
+
+    if response['status'] != 'ok':
+        sys.exit('segmentation failed on the daemon:\n%s' % response['error'])
+
+    print("\n prediction: %s" % response['prediction'])
+
+    return response['prediction']
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """ Queue each request for the inference worker and wait for its result
+    """
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError as error:
+            response = {'status': 'error', 'error': 'invalid request: %s' % error}
+        else:
+            if request.get('cmd') == 'ping':
+                response = {'status': 'ok'}
+            else:
+                done = threading.Event()
+                job = {'request': request, 'done': done}
+                self.server.jobs.put(job)
+                done.wait()
+                response = job['response']
+
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class SegServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        socketserver.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+        self.jobs = queue.Queue()
+
+
+def load_models():
+    """
+    Load all available ventricle models into the registry
+    """
+    from ventmapper.deep.predict import get_model
+    from ventmapper.segment.ventmapper import get_model_files
+
+    for model_name in ['vent_t1only', 'vent_t1fl', 'vent_multi']:
+        try:
+            model_json, model_weights = get_model_files(model_name)
+        except AssertionError as error:
+            print("\n %s" % error)
+            continue
+        print("\n warming up %s" % model_name)
+        get_model(model_name, model_json, model_weights)
+
+
+def run_job(request):
+    """
+    Run a queued request
+    :param request: request dict
+    :return: response dict
+    """
+    from ventmapper.segment import ventmapper
+
+    if request.get('cmd') != 'seg_vent':
+        return {'status': 'error', 'error': 'unknown command: %s' % request.get('cmd')}
+
+    try:
+        prediction = ventmapper.main(argparse.Namespace(**request['args']))
+    except (Exception, SystemExit):
+        return {'status': 'error', 'error': traceback.format_exc()}
+
+    return {'status': 'ok', 'prediction': prediction}
+
+
+def main(args):
+    parser = parsefn()
+    socket_path = parse_inputs(parser, args)
+
+    if os.path.exists(socket_path):
+        try:
+            send_request(socket_path, {'cmd': 'ping'})
+            sys.exit('a daemon is already listening on %s' % socket_path)
+        except (ConnectionError, OSError):
+            os.remove(socket_path)
+
+    load_models()
+
+    server = SegServer(socket_path)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    print(colored("\n listening on %s" % socket_path, 'green'))
+
+    # requests are processed one at a time by this thread, which owns the models
+    try:
+        while True:
+            job = server.jobs.get()
+            job['response'] = run_job(job['request'])
+            job['done'].set()
+    except KeyboardInterrupt:
+        print("\n shutting down")
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
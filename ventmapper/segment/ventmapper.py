@@ -4,25 +4,23 @@
 
 import argcomplete
 import argparse
+import concurrent.futures
 import glob
 import nibabel as nib
 import numpy as np
 import os
 import sys
 from datetime import datetime
-from nilearn.image import reorder_img, resample_img, resample_to_img, math_img, smooth_img, \
-    largest_connected_component_img
-from nipype.interfaces.c3 import C3d
 from pathlib import Path
-from scipy import ndimage
 import functools
 from termcolor import colored
-import subprocess
 
 
-from ventmapper.deep.predict import run_test_case
-from ventmapper.qc import seg_qc
-from ventmapper.utils import endstatement
+from ventmapper.deep.backend import BACKENDS, INFER_PRECISIONS
+from ventmapper.preprocess import inmemory, orient
+from ventmapper.segment.serve import seg_vent_client
+from ventmapper.utils import endstatement, trace
+from ventmapper.utils.stage_cache import StageCache, data_hash
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
 
@@ -41,12 +39,63 @@ def parsefn():
     optional.add_argument('-o', '--out', type=str, metavar='', help="output prediction")
     optional.add_argument('-f', '--force', help="overwrite existing segmentation", action='store_true')
     optional.add_argument('-ss', '--session', type=str, metavar='', help="input session for longitudinal studies")
+    optional.add_argument('-l', '--subj_list', type=str, metavar='',
+                          help="cohort mode: directory of subjects or text file with one subject dir per line")
+    optional.add_argument('-bs', '--batch_size', type=int, metavar='', default=4,
+                          help="cohort mode: number of subjects per forward pass (default: %(default)s)")
+    add_seg_opts(optional)
+    optional.add_argument('-sv', '--server', type=str, metavar='',
+                          help="run through a 'ventmapper serve' daemon listening on this socket")
 
     # optional.add_argument("-h", "--help", action="help", help="Show this help message and exit")
 
     return parser
 
 
+def add_seg_opts(group):
+    """
+    Add the segmentation pipeline options, shared by seg_vent and seg_cohort
+    :param group: parser argument group
+    """
+    group.add_argument('-e', '--engine', type=str, metavar='', default='c3d', choices=['c3d', 'numpy'],
+                       help="preprocessing engine: c3d subprocesses or in-memory numpy, whose standardization can "
+                            "differ from c3d, compare them with 'ventmapper std_img -c' (default: %(default)s)")
+    group.add_argument('-nc', '--no_cache', help="recompute all stages instead of reusing unchanged outputs",
+                       action='store_true')
+    group.add_argument('-ps', '--patch_step', type=int, metavar='', default=None,
+                       help="predict at native resolution with overlapping patches spaced by this many voxels, "
+                            "at most the patch size of 128 (default: resample to 128^3)")
+    group.add_argument('-pb', '--patch_batch', type=int, metavar='', default=2,
+                       help="number of patches per forward pass (default: %(default)s)")
+    group.add_argument('-pr', '--precision', type=str, metavar='', default='float32', choices=INFER_PRECISIONS,
+                       help="inference precision: %s, check its accuracy with 'ventmapper prec_check' "
+                            "(default: %%(default)s)" % ', '.join(INFER_PRECISIONS))
+    group.add_argument('-bk', '--backend', type=str, metavar='', default='keras', choices=BACKENDS,
+                       help="inference backend: keras, or a graph exported with 'ventmapper export_model' "
+                            "(pb: frozen tensorflow graph, onnx: onnxruntime) (default: %(default)s)")
+    group.add_argument('-np', '--no_prob', help="do not save the probability map of the prediction",
+                       action='store_true')
+    group.add_argument('-bl', '--blend', type=str, metavar='', default='gaussian', choices=['gaussian', 'linear'],
+                       help="weighting of overlapping patches (default: %(default)s)")
+
+
+def get_seg_opts(args):
+    """
+    Get the segmentation pipeline options (keyword arguments of seg_subj / seg_cohort)
+    """
+    # patches further apart than their size would leave voxels without a prediction
+    patch_step = getattr(args, 'patch_step', None)
+    if patch_step is not None and not 0 < patch_step <= 128:
+        sys.exit('patch_step (-ps) must be between 1 and the patch size (128), got %d' % patch_step)
+
+    infer_opts = dict(patch_step=patch_step, patch_batch=getattr(args, 'patch_batch', 2),
+                      blend=getattr(args, 'blend', 'gaussian'), precision=getattr(args, 'precision', 'float32'),
+                      backend=getattr(args, 'backend', 'keras'))
+
+    return dict(engine=getattr(args, 'engine', 'c3d'), use_cache=not getattr(args, 'no_cache', False),
+                save_prob=not getattr(args, 'no_prob', False), infer_opts=infer_opts)
+
+
 def parse_inputs(parser, args):
     if isinstance(args, list):
         args = parser.parse_args(args)
@@ -72,8 +121,7 @@ def parse_inputs(parser, args):
     assert os.path.exists(t1), "%s does not exist ... please check path and rerun script" % t1
 
     if args.subj is not None:
-        fl = '%s/%s_T1acq_nu_FL.nii.gz' % (subj_dir, subj)
-        t2 = '%s/%s_T1acq_nu_T2.nii.gz' % (subj_dir, subj)
+        fl, t2 = get_subj_seqs(subj_dir, subj)
     else:
         fl = args.flair
         t2 = args.t2w
@@ -88,43 +136,86 @@ def parse_inputs(parser, args):
     # return subj_dir, subj, t1, fl, mask, out, force
     return subj_dir, subj, t1, fl, t2, mask, out, force
 
-def orient_img(in_img_file, orient_tag, out_img_file):
-    c3 = C3d()
-    c3.inputs.in_file = in_img_file
-    c3.inputs.args = "-orient %s" % orient_tag
-    c3.inputs.out_file = out_img_file
-    c3.run()
 
-def check_orient(in_img_file, r_orient, l_orient, out_img_file):
+def get_subj_seqs(subj_dir, subj):
+    """
+    Get FLAIR and T2 of a subject dir following the naming convention, None if missing
     """
-    Check image orientation and re-orient if not in standard orientation (RPI or LPI)
+    fl = '%s/%s_T1acq_nu_FL.nii.gz' % (subj_dir, subj)
+    t2 = '%s/%s_T1acq_nu_T2.nii.gz' % (subj_dir, subj)
+
+    return (fl if os.path.exists(fl) else None), (t2 if os.path.exists(t2) else None)
+
+
+def get_cohort_subjs(subj_list):
+    """
+    Get subject dirs from a directory of subjects or a text file with one subject dir per line
+    :param subj_list: input directory or subject list
+    :return: list of absolute subject dirs
+    """
+    if os.path.isdir(subj_list):
+        subj_dirs = [os.path.join(subj_list, subj) for subj in sorted(os.listdir(subj_list))
+                     if os.path.isdir(os.path.join(subj_list, subj))]
+    else:
+        with open(subj_list, 'r') as list_file:
+            subj_dirs = [line.strip() for line in list_file if line.strip() and not line.startswith('#')]
+
+    return [os.path.abspath(subj_dir) for subj_dir in subj_dirs]
+
+
+def parse_cohort_inputs(subj_list, force):
+    """
+    Resolve the input files of every subject in a cohort, skipping incomplete or already segmented subjects
+    :return: list of (subj_dir, subj, t1, fl, t2, mask, out, force)
+    """
+    cohort = []
+
+    for subj_dir in get_cohort_subjs(subj_list):
+        subj = os.path.basename(subj_dir)
+        t1 = '%s/%s_T1_nu.nii.gz' % (subj_dir, subj)
+        mask = '%s/%s_T1acq_nu_HfB_pred.nii.gz' % (subj_dir, subj)
+
+        if not (os.path.exists(t1) and os.path.exists(mask)):
+            print("\n %s is missing the t1 or brain mask ... skipping" % subj)
+            continue
+
+        if os.path.exists(get_prediction_files(subj_dir, subj, None)) and force is False:
+            print("\n %s already segmented" % subj)
+            continue
+
+        fl, t2 = get_subj_seqs(subj_dir, subj)
+        cohort.append((subj_dir, subj, t1, fl, t2, mask, None, force))
+
+    return cohort
+
+def check_orient(in_img_file, r_orient, l_orient, out_img_file=None, cache=None):
+    """
+    Check image orientation from its header and re-orient in memory if not in standard orientation (RPI or LPI)
     :param in_img_file: input_image
     :param r_orient: right ras orientation
     :param l_orient: left las orientation
-    :param out_img_file: output oriented image
+    :param out_img_file: output oriented image, only written if re-oriented (for tools reading from disk)
+    :param cache: stage cache (default: no caching)
+    :return: image in standard orientation, original orientation (None if already in standard orientation)
     """
-    res = subprocess.run('c3d %s -info' % in_img_file, shell=True, stdout=subprocess.PIPE)
-    out = res.stdout.decode('utf-8')
-    ort_str = out.find('orient =') + 9
-    img_ort = out[ort_str:ort_str + 3]
+    img_name = os.path.basename(in_img_file).split('.')[0]
 
-    cp_orient = False
-    if (img_ort != r_orient) and (img_ort != l_orient):
-        print("\n Warning: input image is not in RPI or LPI orientation.. "
-              "\n re-orienting image to standard orientation based on orient tags (please make sure they are correct)")
+    with trace.stage('check_orient:%s' % img_name):
+        img, img_ort = orient.std_orient(nib.load(in_img_file), r_orient, l_orient)
 
-        if img_ort == 'Obl':
-            img_ort = out[-5:-2]
-            orient_tag = 'RPI' if 'R' in img_ort else 'LPI'
+    if img_ort is not None and out_img_file is not None:
+        if cache is None:
+            nib.save(img, out_img_file)
         else:
-            orient_tag = 'RPI' if 'R' in img_ort else 'LPI'
-        print("re-orienting to %s ..." % orient_tag)
-        orient_img(in_img_file, orient_tag, out_img_file)
-        cp_orient = True
-    return cp_orient
+            cache.run('orient:%s' % img_name, lambda: nib.save(img, out_img_file),
+                      [in_img_file], [out_img_file], params={'orient': orient.get_orient(img)})
+
+    return img, img_ort
 
 
 def resample(image, new_shape, interpolation="linear"):
+    from nilearn.image import reorder_img, resample_img
+
     print("\n resampling ...")
     input_shape = np.asarray(image.shape, dtype=image.get_data_dtype())
     ras_image = reorder_img(image, resample=interpolation)
@@ -137,6 +228,7 @@ def resample(image, new_shape, interpolation="linear"):
 
 def image_mask(img, mask, img_masked):
     print("\n skull stripping ...")
+    from nipype.interfaces.c3 import C3d
     c3 = C3d()
     c3.inputs.in_file = img
     c3.inputs.args = "%s -multiply" % mask
@@ -145,6 +237,7 @@ def image_mask(img, mask, img_masked):
 
 def image_standardize(img, mask, img_std):
     print("\n standardization ...")
+    from nipype.interfaces.c3 import C3d
     c3 = C3d()
     c3.inputs.in_file = img
     c3.inputs.args = "%s -nlw 25x25x25 %s -times -replace nan 0" % (mask, mask)
@@ -153,6 +246,7 @@ def image_standardize(img, mask, img_std):
 
 def trim(img, out, voxels=1):
     print("\n cropping ...")
+    from nipype.interfaces.c3 import C3d
     c3 = C3d()
     c3.inputs.in_file = img
     c3.inputs.args = "-trim %svox" % voxels
@@ -161,159 +255,467 @@ def trim(img, out, voxels=1):
 
 def trim_like(img, ref, out, interp = 0):
     print("\n cropping ...")
+    from nipype.interfaces.c3 import C3d
     c3 = C3d()
     c3.inputs.in_file = ref
     c3.inputs.args = "-int %s %s -reslice-identity" % (interp, img)
     c3.inputs.out_file = out
     c3.run()
 
-def copy_orient(in_img_file, ref_img_file, out_img_file):
-    print("\n copy orientation ...")
-    c3 = C3d()
-    c3.inputs.in_file = ref_img_file
-    c3.inputs.args = "%s -copy-transform -type uchar" % in_img_file
-    c3.inputs.out_file = out_img_file
-    c3.run()
+def get_model_name(t1, fl, t2):
+    """
+    Select the model based on the available sequences
+    :return: test sequences, training modalities, model name
+    """
+    # if fl is None or t2 is None:
+    if fl is None and t2 is None:
+        model_name = 'vent_t1only'
+        print("\n found only t1-w, using the %s model" % model_name)
+        return [t1], ["t1"], model_name
+    elif t2 is None and fl:
+        print("\n found the t1-w and FLAIR, using the t1-flair model")
+        return [t1, fl], ["t1", "flair"], 'vent_t1fl'
+    else:
+        print("\n found all 3 sequences, using the model with all 3 sequences")
+        return [t1, fl, t2], ["t1", "flair", "t2"], 'vent_multi'
 
-def main(args):
-    parser = parsefn()
-    subj_dir, subj, t1, fl, t2, mask, out, force = parse_inputs(parser, args)
-    cp_orient = False
 
+def get_model_files(model_name):
+    """
+    Get the json and weights of a trained model
+    """
+    file_path = os.path.realpath(__file__)
+    hyper_dir = Path(file_path).parents[2]
+
+    model_json = '%s/models/%s_model.json' % (hyper_dir, model_name)
+    model_weights = '%s/models/%s_model_weights.h5' % (hyper_dir, model_name)
+
+    assert os.path.exists(model_json), "%s does not exist ... please download and rerun script" % model_json
+    assert os.path.exists(model_weights), \
+        "%s model does not exist ... please download and rerun script" % model_weights
+
+    return model_json, model_weights
+
+
+def get_prediction_files(subj_dir, subj, out):
+    """
+    Get the final prediction name
+    """
     if out is None:
         prediction = '%s/%s_T1acq_nu_ventricles_pred.nii.gz' % (subj_dir, subj)
-        prediction_std_orient = '%s/%s_T1acq_nu_ventricles_pred_std_orient.nii.gz' % (subj_dir, subj)
     else:
         prediction = out
-        prediction_std_orient = "%s/%s_std_orient.nii.gz" % (subj_dir, os.path.basename(out).split('.')[0])
 
-    if os.path.exists(prediction) and force is False:
-        print("\n %s already exists" % prediction)
+    return prediction
+
+
+def get_pred_dir(subj_dir):
+    """
+    Get (and create) the pred preprocess dir of a subject
+    """
+    pred_dir = '%s/pred_process' % os.path.abspath(subj_dir)
+    if not os.path.exists(pred_dir):
+        os.mkdir(pred_dir)
+
+    return pred_dir
+
+
+def preprocess_seq_c3d(in_seq, in_mask, pred_dir, seq_name, t1_name, is_t1, cache, wait_ref=None):
+    """
+    Mask, standardize and crop a sequence with c3d
+    :param wait_ref: called before cropping a non-t1 sequence, waits for the cropped t1
+    :return: cropped image
+    """
+    # masked
+    seq_masked = "%s/%s_masked.nii.gz" % (pred_dir, seq_name)
+    cache.run('mask:%s' % seq_name, lambda: image_mask(in_seq, in_mask, seq_masked), [in_seq, in_mask], [seq_masked])
+
+    # standardized
+    seq_std = "%s/%s_masked_standardized.nii.gz" % (pred_dir, seq_name)
+    cache.run('standardize:%s' % seq_name, lambda: image_standardize(seq_masked, in_mask, seq_std),
+              [seq_masked, in_mask], [seq_std])
+
+    # cropping
+    seq_crop = '%s/%s_masked_standardized_cropped.nii.gz' % (pred_dir, seq_name)
+    if is_t1:
+        cache.run('crop:%s' % seq_name, lambda: trim(seq_std, seq_crop, voxels=1), [seq_std], [seq_crop],
+                  params={'voxels': 1})
     else:
-        start_time = datetime.now()
+        ref_file = '%s/%s_masked_standardized_cropped.nii.gz' % (pred_dir, t1_name)
+        if wait_ref is not None:
+            wait_ref()
+        cache.run('crop:%s' % seq_name, lambda: trim_like(seq_std, ref_file, seq_crop, interp=1),
+                  [seq_std, ref_file], [seq_crop], params={'interp': 1})
+
+    return seq_crop
+
 
-        file_path = os.path.realpath(__file__)
-        hyper_dir = Path(file_path).parents[2]
-
-        # if fl is None or t2 is None:
-        if fl is None and t2 is None:
-            test_seqs = [t1]
-            training_mods = ["t1"]
-            model_name = 'vent_t1only'
-            print("\n found only t1-w, using the %s model" % model_name)
-        elif t2 is None and fl:
-            test_seqs = [t1, fl]
-            training_mods = ["t1", "flair"]
-            model_name = 'vent_t1fl'
-            print("\n found the t1-w and FLAIR, using the t1-flair model")
+def preprocess_seq_numpy(seq_img, mask_data, ref_img=None, wait_ref=None, seq_name='img'):
+    """
+    Mask, standardize and crop a sequence in memory
+    :param seq_img: sequence image
+    :param mask_data: brain mask array
+    :param ref_img: uncropped t1 (None if seq_img is the t1)
+    :param wait_ref: waits for and returns the t1 bounding box (None if seq_img is the t1)
+    :param seq_name: sequence name (for tracing)
+    :return: cropped image, bounding box
+    """
+    print("\n skull stripping ...")
+    with trace.stage('mask:%s' % seq_name):
+        seq_masked = inmemory.mask_data(np.asanyarray(seq_img.dataobj), mask_data)
+
+    print("\n standardization ...")
+    with trace.stage('standardize:%s' % seq_name):
+        seq_std = inmemory.standardize_data(seq_masked, mask_data)
+
+    if ref_img is not None:
+        bbox = wait_ref()
+
+    print("\n cropping ...")
+    with trace.stage('crop:%s' % seq_name):
+        if ref_img is None:
+            bbox = inmemory.get_bbox(seq_std, voxels=1)
+            return inmemory.crop_img(seq_std, seq_img.affine, bbox), bbox
         else:
-            test_seqs = [t1, fl, t2]
-            training_mods = ["t1", "flair", "t2"]
-            model_name = 'vent_multi'
-            print("\n found all 3 sequences, using the model with all 3 sequences")
-
-        model_json = '%s/models/%s_model.json' % (hyper_dir, model_name)
-        model_weights = '%s/models/%s_model_weights.h5' % (hyper_dir, model_name)
-
-        assert os.path.exists(model_json), "%s does not exist ... please download and rerun script" % model_json
-        assert os.path.exists(model_weights), \
-            "%s model does not exist ... please download and rerun script" % model_weights
-
-        # pred preprocess dir
-        print(colored("\n pre-processing ...", 'green'))
-        pred_dir = '%s/pred_process' % os.path.abspath(subj_dir)
-        if not os.path.exists(pred_dir):
-            os.mkdir(pred_dir)
-
-        # standardize intensity and mask data
-        c3 = C3d()
-
-        pred_shape = [128, 128, 128]
-        # std orientations
-        r_orient = 'RPI'
-        l_orient = 'LPI'
-
-        # check orientation t1 and mask
-        t1_ort = "%s/%s_std_orient.nii.gz" % (subj_dir, os.path.basename(t1).split('.')[0])
-        cp_orient = check_orient(t1, r_orient, l_orient, t1_ort)
-        mask_ort = "%s/%s_std_orient.nii.gz" % (subj_dir, os.path.basename(mask).split('.')[0])
-        cp_orient_m = check_orient(mask, r_orient, l_orient, mask_ort)
-        in_mask = mask_ort if os.path.exists(mask_ort) else mask
-
-        # loading t1
-        in_t1 = t1_ort if os.path.exists(t1_ort) else t1
-        t1_img = nib.load(in_t1)
-
-        test_data = np.zeros((1, len(training_mods), pred_shape[0], pred_shape[1], pred_shape[2]), dtype=t1_img.get_data_dtype())
-
-        for s, seq in enumerate(test_seqs):
-            print(colored("\n pre-processing %s" % os.path.basename(seq).split('.')[0], 'green'))
-
-            seq_ort = "%s/%s_std_orient.nii.gz" % (subj_dir, os.path.basename(seq).split('.')[0])
-            if training_mods[s] != 't1':
+            return inmemory.crop_like(seq_std, seq_img.affine, ref_img.shape, ref_img.affine, bbox), bbox
+
+
+def preprocess_subj(subj_dir, t1, test_seqs, training_mods, mask, pred_shape, engine='c3d', cache=None):
+    """
+    Re-orient, mask, standardize, crop and resample all sequences of a subject
+    :param pred_shape: shape to resample to (None to keep the cropped data at native resolution)
+    :param engine: 'c3d' (c3d subprocesses) or 'numpy' (in memory)
+    :param cache: stage cache of the subject (default: no caching)
+    :return: test data (mods x pred_shape), affine of resampled data, t1 image in standard orientation,
+             original t1 orientation (None if not re-oriented)
+    """
+    from nilearn.image import reorder_img
+
+    # pred preprocess dir
+    print(colored("\n pre-processing ...", 'green'))
+    pred_dir = get_pred_dir(subj_dir)
+    cache = cache if cache is not None else StageCache(pred_dir, enabled=False)
+
+    # std orientations
+    r_orient = 'RPI'
+    l_orient = 'LPI'
+
+    # check orientation t1 and mask (re-oriented copies are only written for c3d)
+    t1_ort = "%s/%s_std_orient.nii.gz" % (subj_dir, os.path.basename(t1).split('.')[0])
+    mask_ort = "%s/%s_std_orient.nii.gz" % (subj_dir, os.path.basename(mask).split('.')[0])
+    if engine == 'numpy':
+        t1_ort = mask_ort = None
+
+    t1_img, t1_orient = check_orient(t1, r_orient, l_orient, t1_ort, cache)
+    mask_img, mask_orient = check_orient(mask, r_orient, l_orient, mask_ort, cache)
+    in_mask = mask_ort if mask_orient else mask
+
+    test_data = []
+
+    if engine == 'numpy':
+        # in-memory stages are cached together as the final test data
+        test_data_file = '%s/%s_test_data.npz' % (pred_dir, os.path.basename(t1).split('.')[0])
+        cached, key = cache.lookup('preprocess', test_seqs + [mask],
+                                   params={'mods': training_mods, 'shape': pred_shape, 'engine': engine})
+        if cached:
+            print("\n preprocess: inputs unchanged, using cached outputs")
+            with np.load(test_data_file) as cached_data:
+                return cached_data['test_data'], cached_data['affine'], t1_img, t1_orient
+
+        mask_data = np.asanyarray(mask_img.dataobj)
+
+    t1_name = os.path.basename(t1).split('.')[0]
+    # other sequences are masked and standardized concurrently with the t1, then cropped like it
+    t1_cropped = concurrent.futures.Future()
+
+    def preprocess_seq(s, seq):
+        seq_name = os.path.basename(seq).split('.')[0]
+        is_t1 = training_mods[s] == 't1'
+        print(colored("\n pre-processing %s" % seq_name, 'green'))
+
+        try:
+            if is_t1:
+                seq_img, seq_orient, seq_ort = t1_img, t1_orient, t1_ort
+            else:
                 # check orientation
-                cp_orient_seq = check_orient(seq, r_orient, l_orient, seq_ort)
-            in_seq = seq_ort if os.path.exists(seq_ort) else seq
+                seq_ort = None if engine == 'numpy' else "%s/%s_std_orient.nii.gz" % (subj_dir, seq_name)
+                seq_img, seq_orient = check_orient(seq, r_orient, l_orient, seq_ort, cache)
+            in_seq = seq_ort if seq_orient else seq
 
-            # masked
-            seq_masked = "%s/%s_masked.nii.gz" % (pred_dir, os.path.basename(seq).split('.')[0])
-            image_mask(in_seq, in_mask, seq_masked)
+            if engine == 'numpy':
+                if is_t1:
+                    img, bbox = preprocess_seq_numpy(seq_img, mask_data, seq_name=seq_name)
+                    t1_cropped.set_result(bbox)
+                else:
+                    img, bbox = preprocess_seq_numpy(seq_img, mask_data, t1_img, t1_cropped.result, seq_name)
+                with trace.stage('resample:%s' % seq_name):
+                    return resample(img, pred_shape) if pred_shape else reorder_img(img, resample='linear')
 
-            # standardized
-            seq_std = "%s/%s_masked_standardized.nii.gz" % (pred_dir, os.path.basename(seq).split('.')[0])
-            image_standardize(seq_masked, in_mask, seq_std)
+            seq_crop = preprocess_seq_c3d(in_seq, in_mask, pred_dir, seq_name, t1_name, is_t1, cache,
+                                          wait_ref=None if is_t1 else t1_cropped.result)
+            if is_t1:
+                t1_cropped.set_result(seq_crop)
 
-            # cropping
-            if training_mods[s] == 't1':
-                seq_crop = '%s/%s_masked_standardized_cropped.nii.gz' % (pred_dir, os.path.basename(seq).split('.')[0])
-                trim(seq_std, seq_crop, voxels=1)
-            else:
-                seq_crop = '%s/%s_masked_standardized_cropped.nii.gz' % (pred_dir, os.path.basename(seq).split('.')[0])
-                ref_file = '%s/%s_masked_standardized_cropped.nii.gz' % (pred_dir, os.path.basename(t1).split('.')[0])
-                trim_like(seq_std, ref_file, seq_crop, interp=1)
-
-            # resampling
-            img = nib.load(seq_crop)
-            res = resample(img, [pred_shape[0], pred_shape[1], pred_shape[2]])
-            seq_res = '%s/%s_resampled.nii.gz' % (pred_dir, os.path.basename(seq).split('.')[0])
-            nib.save(res, seq_res)
-
-            if not os.path.exists(seq_res):
-                print("\n pre-processing %s" % training_mods[s])
-                c3.run()
-            res_data = nib.load(seq_res)
-            test_data[0, s, :, :, :] = res_data.get_data()
-
-        print(colored("\n generating ventricle segmentation", 'green'))
-
-        res_t1_file = '%s/%s_resampled.nii.gz' % (pred_dir, os.path.basename(t1).split('.')[0])
-        res = nib.load(res_t1_file)
-
-        pred = run_test_case(test_data=test_data, model_json=model_json, model_weights=model_weights,
-                             affine=res.affine, output_label_map=True, labels=1)
-
-        # resample back
-        pred_res = resample_to_img(pred, t1_img)
-        pred_prob_name = os.path.join(pred_dir, "%s_%s_pred_prob.nii.gz" % (subj, model_name))
-        nib.save(pred_res, pred_prob_name)
-
-        pred_res_th = math_img('img > 0.5', img=pred_res)
-        pred_name = os.path.join(pred_dir, "%s_%s_pred.nii.gz" % (subj, model_name))
-        nib.save(pred_res_th, pred_name)
-
-        # copy original orientation to final prediction
-        if cp_orient:
-            nib.save(pred_res_th, prediction_std_orient)
-            copy_orient(pred_name, t1, prediction)
+        except BaseException as error:
+            # unblock sequences waiting for the t1
+            if is_t1 and not t1_cropped.done():
+                t1_cropped.set_exception(error)
+            raise
+
+        # resampling
+        if pred_shape:
+            seq_res = '%s/%s_resampled.nii.gz' % (pred_dir, seq_name)
+            cache.run('resample:%s' % seq_name, lambda: nib.save(resample(nib.load(seq_crop), pred_shape), seq_res),
+                      [seq_crop], [seq_res], params={'shape': pred_shape})
+            return nib.load(seq_res)
+
+        with trace.stage('resample:%s' % seq_name):
+            return reorder_img(nib.load(seq_crop), resample='linear')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(test_seqs)) as executor:
+        jobs = [executor.submit(preprocess_seq, s, seq) for s, seq in enumerate(test_seqs)]
+        res_imgs = [job.result() for job in jobs]
+
+    for s, res in enumerate(res_imgs):
+        test_data.append(np.asanyarray(res.dataobj))
+
+        if training_mods[s] == 't1':
+            res_affine = res.affine
+
+    test_data = np.stack(test_data).astype(np.float32)
+
+    if engine == 'numpy' and cache.enabled:
+        np.savez(test_data_file, test_data=test_data, affine=res_affine)
+        cache.store('preprocess', key, [test_data_file])
+
+    return test_data, res_affine, t1_img, t1_orient
+
+
+def lookup_pred(cache, subj, model_name, model_json, model_weights, test_data, res_affine, infer_opts):
+    """
+    Look up a cached prediction of the test data
+    :return: cached prediction (None if not cached), stage key, prediction file
+    """
+    pred_file = os.path.join(os.path.dirname(cache.manifest_file), "%s_%s_pred_res.nii.gz" % (subj, model_name))
+    cached, key = cache.lookup('inference', [model_json, model_weights],
+                               params={'model': model_name, 'data': data_hash(test_data, res_affine),
+                                       'opts': infer_opts})
+    if cached:
+        print("\n inference: inputs unchanged, using cached outputs")
+
+    return (nib.load(pred_file) if cached else None), key, pred_file
+
+
+def predict_subjs(test_data, affines, model_name, model_json, model_weights, infer_opts):
+    """
+    Predict subjects, stacked in one forward pass or one by one with overlapping patches
+    :param test_data: list of test data arrays (mods x pred_shape)
+    :param affines: affine of each test data
+    :param infer_opts: inference options (patch_step, patch_batch, blend, precision, backend)
+    :return: list of predicted images
+    """
+    from ventmapper.deep.predict import run_test_batch, run_sliding_window
+
+    precision = infer_opts.get('precision', 'float32')
+    backend = infer_opts.get('backend', 'keras')
+
+    if infer_opts.get('patch_step'):
+        return [run_sliding_window(test_data=data, model_json=model_json, model_weights=model_weights,
+                                   affine=affine, output_label_map=True, labels=1, model_name=model_name,
+                                   step=infer_opts['patch_step'], batch_size=infer_opts['patch_batch'],
+                                   blend=infer_opts['blend'], precision=precision, backend=backend)
+                for data, affine in zip(test_data, affines)]
+
+    return run_test_batch(test_data=np.stack(test_data), model_json=model_json, model_weights=model_weights,
+                          affines=affines, output_label_map=True, labels=1, model_name=model_name,
+                          precision=precision, backend=backend)
+
+
+def store_pred(cache, key, pred, pred_file):
+    """
+    Save and record a prediction in the stage cache
+    """
+    if cache.enabled:
+        nib.save(pred, pred_file)
+        cache.store('inference', key, [pred_file])
+
+
+def save_prediction(pred, t1_img, subj_dir, subj, t1, model_name, prediction, t1_orient, cache=None,
+                    save_prob=True):
+    """
+    Resample prediction back to t1 space, threshold, restore original orientation and generate qc mosaic
+    (resampling is restricted to the field of view of the prediction, voxels outside it are background)
+    """
+    from ventmapper.qc import seg_qc
+
+    pred_dir = get_pred_dir(subj_dir)
+    cache = cache if cache is not None else StageCache(pred_dir, enabled=False)
+
+    pred_prob_name = os.path.join(pred_dir, "%s_%s_pred_prob.nii.gz" % (subj, model_name))
+    pred_name = os.path.join(pred_dir, "%s_%s_pred.nii.gz" % (subj, model_name))
+
+    # resample back
+    with trace.stage('resample_back') as record:
+        cached, key = cache.lookup('resample_back', [t1],
+                                   params={'pred': data_hash(np.asanyarray(pred.dataobj), pred.affine),
+                                           'threshold': 0.5, 'prob': save_prob})
+        record['cached'] = cached
+        if cached:
+            print("\n resample_back: inputs unchanged, using cached outputs")
+            pred_res_th = nib.load(pred_name)
         else:
-            nib.save(pred_res_th, prediction)
+            pred_res_th, pred_res = inmemory.resample_back(pred, t1_img, threshold=0.5, prob=save_prob)
+            nib.save(pred_res_th, pred_name)
 
-        print("\n generating mosaic image for qc")
+            outputs = [pred_name]
+            if save_prob:
+                nib.save(pred_res, pred_prob_name)
+                outputs.append(pred_prob_name)
+            cache.store('resample_back', key, outputs)
 
-        seg_qc.main(['-i', '%s' % t1, '-s', '%s' % prediction, '-g', '2', '-m', '40'])
+    # restore original orientation of final prediction
+    with trace.stage('save'):
+        if t1_orient:
+            pred_res_th = orient.reorient(pred_res_th, t1_orient)
+
+        nib.save(pred_res_th, prediction)
+
+    print("\n generating mosaic image for qc")
+
+    seg_qc.main(['-i', '%s' % t1, '-s', '%s' % prediction, '-g', '2', '-m', '40'])
+
+
+def seg_subj(subj_dir, subj, t1, fl, t2, mask, out, force, engine='c3d', use_cache=True, save_prob=True,
+             infer_opts=None):
+    """
+    Segment the ventricles of a single subject
+    """
+    infer_opts = infer_opts if infer_opts is not None else {}
+    prediction = get_prediction_files(subj_dir, subj, out)
+
+    if os.path.exists(prediction) and force is False:
+        print("\n %s already exists" % prediction)
+    else:
+        start_time = datetime.now()
+
+        with trace.tracing(subj_dir, subj, 'seg_vent'):
+            test_seqs, training_mods, model_name = get_model_name(t1, fl, t2)
+
+            model_json, model_weights = get_model_files(model_name)
+
+            pred_shape = None if infer_opts.get('patch_step') else [128, 128, 128]
+
+            cache = StageCache(get_pred_dir(subj_dir), enabled=use_cache)
+
+            with trace.stage('preprocess'):
+                test_data, res_affine, t1_img, t1_orient = preprocess_subj(subj_dir, t1, test_seqs, training_mods,
+                                                                           mask, pred_shape, engine=engine,
+                                                                           cache=cache)
+
+            print(colored("\n generating ventricle segmentation", 'green'))
+
+            with trace.stage('inference', model=model_name) as record:
+                pred, key, pred_file = lookup_pred(cache, subj, model_name, model_json, model_weights, test_data,
+                                                   res_affine, infer_opts)
+                record['cached'] = pred is not None
+                if pred is None:
+                    pred = predict_subjs([test_data], [res_affine], model_name, model_json, model_weights,
+                                         infer_opts)[0]
+                    store_pred(cache, key, pred, pred_file)
+
+            save_prediction(pred, t1_img, subj_dir, subj, t1, model_name, prediction, t1_orient, cache, save_prob)
 
         endstatement.main('Ventricles prediction and mosaic generation', '%s' % (datetime.now() - start_time))
 
+    return prediction
+
+
+def seg_cohort(cohort, batch_size, engine='c3d', use_cache=True, save_prob=True, infer_opts=None):
+    """
+    Segment the ventricles of a cohort, grouping subjects by model and running one forward pass per batch
+    :param cohort: list of subject inputs (subj_dir, subj, t1, fl, t2, mask, out, force)
+    :param batch_size: number of subjects stacked per forward pass
+    :param engine: preprocessing engine
+    :param use_cache: reuse outputs of unchanged stages
+    :param save_prob: save the probability maps of the predictions
+    :param infer_opts: inference options (patch_step, patch_batch, blend, precision, backend)
+    """
+    start_time = datetime.now()
+    infer_opts = infer_opts if infer_opts is not None else {}
+    pred_shape = None if infer_opts.get('patch_step') else [128, 128, 128]
+    predictions = []
+
+    # group subjects by the model they need
+    groups = {}
+    for subj_inputs in cohort:
+        subj_dir, subj, t1, fl, t2, mask, out, force = subj_inputs
+        test_seqs, training_mods, model_name = get_model_name(t1, fl, t2)
+        groups.setdefault(model_name, []).append((subj_inputs, test_seqs, training_mods))
+
+    for model_name, group in groups.items():
+        print(colored("\n segmenting %d subjects with the %s model" % (len(group), model_name), 'green'))
+        model_json, model_weights = get_model_files(model_name)
+
+        for b in range(0, len(group), batch_size):
+            batch = group[b:b + batch_size]
+
+            batch_info = []
+            for subj_inputs, test_seqs, training_mods in batch:
+                subj_dir, subj, t1, fl, t2, mask, out, force = subj_inputs
+                print('\n input subject:', subj)
+                cache = StageCache(get_pred_dir(subj_dir), enabled=use_cache)
+                with trace.tracing(subj_dir, subj, 'seg_vent') as tracer:
+                    with trace.stage('preprocess'):
+                        test_data, res_affine, t1_img, t1_orient = preprocess_subj(subj_dir, t1, test_seqs,
+                                                                                   training_mods, mask, pred_shape,
+                                                                                   engine=engine, cache=cache)
+                    pred, key, pred_file = lookup_pred(cache, subj, model_name, model_json, model_weights,
+                                                       test_data, res_affine, infer_opts)
+                batch_info.append([subj_inputs, test_data, res_affine, t1_img, t1_orient, cache, pred, key,
+                                   pred_file, tracer.run])
+
+            # only subjects without a cached prediction go through the model
+            to_pred = [info for info in batch_info if info[6] is None]
+            if to_pred:
+                print(colored("\n generating ventricle segmentations for %d subjects" % len(to_pred), 'green'))
+
+                with trace.measure('inference', model=model_name, batch=len(to_pred)) as record:
+                    preds = predict_subjs([info[1] for info in to_pred], [info[2] for info in to_pred], model_name,
+                                          model_json, model_weights, infer_opts)
+
+                for pred, info in zip(preds, to_pred):
+                    info[6] = pred
+                    store_pred(info[5], info[7], pred, info[8])
+                    # the batch record is shared by its subjects
+                    trace.Tracer(info[0][0], info[0][1], 'seg_vent', info[9]).write(record)
+
+            for subj_inputs, test_data, res_affine, t1_img, t1_orient, cache, pred, key, pred_file, run in batch_info:
+                subj_dir, subj, t1, fl, t2, mask, out, force = subj_inputs
+                prediction = get_prediction_files(subj_dir, subj, out)
+                with trace.tracing(subj_dir, subj, 'seg_vent', run):
+                    save_prediction(pred, t1_img, subj_dir, subj, t1, model_name, prediction, t1_orient, cache,
+                                    save_prob)
+                predictions.append(prediction)
+
+    endstatement.main('Ventricles prediction of %d subjects' % len(cohort), '%s' % (datetime.now() - start_time))
+
+    return predictions
+
+
+def main(args):
+    parser = parsefn()
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+
+    if getattr(args, 'server', None):
+        return seg_vent_client(args, args.server)
+
+    if args.subj_list:
+        cohort = parse_cohort_inputs(args.subj_list, True if args.force else False)
+        return seg_cohort(cohort, args.batch_size, **get_seg_opts(args))
+    else:
+        return seg_subj(*parse_inputs(parser, args), **get_seg_opts(args))
+
 
 if __name__ == "__main__":
     main(sys.argv[1:])
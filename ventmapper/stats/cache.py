@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import json
+import os
+
+TABLE_FORMATS = ['csv', 'parquet', 'feather']
+
+
+class SubjectCache(object):
+    """ Cache of per-subject results of a summary table, keyed by the path, size and mtime of the file they were
+    computed from. Results computed with other parameters are discarded.
+    """
+    def __init__(self, cache_file, params=None, enabled=True):
+        self.cache_file = cache_file
+        self.params = params
+        self.enabled = enabled
+        self.files = {}
+        self.seen = set()
+
+        if enabled and os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r') as json_file:
+                    cache = json.load(json_file)
+                if cache.get('params') == params:
+                    self.files = cache['files']
+            except (ValueError, KeyError):
+                print("\n could not read %s ... ignoring cached results" % cache_file)
+
+    @staticmethod
+    def stamp(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def lookup(self, path):
+        """
+        Cached results of a file
+        :return: results or None if the file is new or changed
+        """
+        path = os.path.abspath(path)
+        self.seen.add(path)
+
+        entry = self.files.get(path)
+        if not self.enabled or entry is None or entry['stamp'] != self.stamp(path):
+            return None
+
+        return entry['results']
+
+    def store(self, path, results):
+        path = os.path.abspath(path)
+        self.seen.add(path)
+        self.files[path] = {'stamp': self.stamp(path), 'results': results}
+
+    def save(self, prune=True):
+        """
+        Write the cache
+        :param prune: drop files not looked up in this run (ex: subjects removed from the cohort)
+        """
+        if not self.enabled:
+            return
+
+        files = {path: entry for path, entry in self.files.items() if path in self.seen} if prune else self.files
+
+        tmp_file = '%s.%d.tmp' % (self.cache_file, os.getpid())
+        with open(tmp_file, 'w') as json_file:
+            json.dump({'params': self.params, 'files': files}, json_file)
+        os.replace(tmp_file, self.cache_file)
+
+
+def check_formats(formats):
+    """
+    Check the libraries writing the columnar formats are installed (before any subject is processed)
+    """
+    if 'parquet' in formats or 'feather' in formats:
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("\n\n Please install pyarrow to save parquet or feather tables:\n 'pip install pyarrow'")
+
+
+def save_table(df, out_csv, formats=('csv',)):
+    """
+    Save a summary table as csv and columnar formats (same name, with a .parquet / .feather extension)
+    :param df: table (indexed by subject)
+    :param out_csv: output csv
+    :param formats: formats to save
+    :return: saved files
+    """
+    out_base = os.path.splitext(out_csv)[0]
+    out_files = []
+
+    for out_format in formats:
+        if out_format == 'csv':
+            df.to_csv(out_csv)
+            out_files.append(out_csv)
+        elif out_format == 'parquet':
+            df.to_parquet('%s.parquet' % out_base)
+            out_files.append('%s.parquet' % out_base)
+        else:
+            df.reset_index().to_feather('%s.feather' % out_base)
+            out_files.append('%s.feather' % out_base)
+
+    return out_files
@@ -0,0 +1,239 @@
+import numpy as np
+import nibabel as nib
+import os
+import pandas as pd
+import warnings
+import argcomplete
+import argparse
+import sys
+import multiprocessing
+from datetime import datetime
+
+from ventmapper.stats.cache import TABLE_FORMATS, check_formats, save_table
+from ventmapper.stats.summary_vent_vols import find_mask
+
+warnings.filterwarnings("ignore")
+
+COLUMNS = ['Subject', 'Path', 'Vol_R', 'Vol_L', 'SA_R', 'SA_L', 'ECC_R', 'ECC_L', 'Elong_R', 'Elong_L', 'HfB_Vol']
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(description='Generates geometry summary (volume, surface area, eccentricity, '
+                                                 'elongation) of left and right ventricles',
+                                     usage="%(prog)s -i [ in_dir ] -o [ out_csv ]")
+
+    required = parser.add_argument_group('required arguments')
+
+    required.add_argument('-i', '--in_dir', type=str, required=True, metavar='',
+                          help='input directory containing subjects')
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-o', '--out_csv', type=str, metavar='', default=None,
+                          help="output csv (default: in_dir/label_geom_<ddmmyy>.csv, the newest label_geom*.csv "
+                               "is read by outlier detection)")
+    optional.add_argument('-s', '--seg_name', type=str, metavar='', default='ventricles_pred.nii.gz',
+                          help="suffix of the ventricle segmentations (default: %(default)s)")
+    optional.add_argument('-b', '--brain_name', type=str, metavar='', default='HfB_pred.nii.gz',
+                          help="suffix of the brain masks (default: %(default)s)")
+    optional.add_argument('-l', '--label', type=int, metavar='', default=1,
+                          help="ventricle label (default: %(default)s)")
+    optional.add_argument('-w', '--workers', type=int, metavar='', default=multiprocessing.cpu_count(),
+                          help="number of processes reading the segmentations (default: %(default)s)")
+    optional.add_argument('-f', '--formats', type=str, nargs='+', metavar='', default=['csv'], choices=TABLE_FORMATS,
+                          help="output formats: %s, columnar formats are saved next to the csv "
+                               "(default: %%(default)s)" % ', '.join(TABLE_FORMATS))
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    out_csv = args.out_csv if args.out_csv else os.path.join(args.in_dir, 'label_geom_%s.csv' %
+                                                             datetime.now().strftime("%d%m%y"))
+
+    return args.in_dir, out_csv, args.seg_name, args.brain_name, args.label, max(args.workers, 1), args.formats
+
+
+def bbox(mask):
+    """
+    Bounding box of a mask, from its projections on each axis (no index arrays)
+    :return: tuple of slices (None if the mask is empty)
+    """
+    slices = []
+    for axis in range(mask.ndim):
+        proj = np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        if proj.size == 0:
+            return None
+        slices.append(slice(proj[0], proj[-1] + 1))
+
+    return tuple(slices)
+
+
+def index_moments(mask):
+    """
+    Voxel count, centroid and covariance of the voxel indices of a mask, from its 2d projections
+    :return: count, centroid (3,), covariance (3, 3)
+    """
+    count = float(np.count_nonzero(mask))
+    if count == 0:
+        return 0., np.full(3, np.nan), np.full((3, 3), np.nan)
+
+    coords = [np.arange(size, dtype=np.float64) for size in mask.shape]
+    proj_ij = mask.sum(axis=2, dtype=np.float64)
+    proj_ik = mask.sum(axis=1, dtype=np.float64)
+    proj_jk = mask.sum(axis=0, dtype=np.float64)
+    marginals = [proj_ij.sum(axis=1), proj_ij.sum(axis=0), proj_ik.sum(axis=0)]
+
+    mean = np.array([marginal @ coord for marginal, coord in zip(marginals, coords)]) / count
+
+    second = np.diag([marginal @ coord ** 2 for marginal, coord in zip(marginals, coords)])
+    second[0, 1] = second[1, 0] = coords[0] @ proj_ij @ coords[1]
+    second[0, 2] = second[2, 0] = coords[0] @ proj_ik @ coords[2]
+    second[1, 2] = second[2, 1] = coords[1] @ proj_jk @ coords[2]
+
+    return count, mean, second / count - np.outer(mean, mean)
+
+
+def surface_area(mask, zooms):
+    """
+    Surface area of a mask by counting the exposed voxel faces
+    :param mask: boolean mask
+    :param zooms: voxel size (mm)
+    :return: surface area (mm^2)
+    """
+    padded = np.pad(mask, 1, mode='constant')
+    face_areas = [zooms[1] * zooms[2], zooms[0] * zooms[2], zooms[0] * zooms[1]]
+
+    return float(sum(np.count_nonzero(np.diff(padded, axis=axis)) * face_areas[axis] for axis in range(3)))
+
+
+def shape_metrics(cov):
+    """
+    Eccentricity and elongation of a shape from the eigenvalues l1 >= l2 >= l3 of its moment tensor:
+    eccentricity = sqrt(1 - l3 / l1) (0 for a sphere, 1 for a line), elongation = sqrt(l1 / l2)
+    :param cov: covariance of the voxel coordinates (mm)
+    :return: eccentricity, elongation
+    """
+    if not np.all(np.isfinite(cov)):
+        return np.nan, np.nan
+
+    l1, l2, l3 = np.clip(np.linalg.eigvalsh(cov)[::-1], 0, None)
+    eccentricity = np.sqrt(1 - l3 / l1) if l1 > 0 else np.nan
+    elongation = np.sqrt(l1 / l2) if l2 > 0 else np.nan
+
+    return float(eccentricity), float(elongation)
+
+
+def region_geom(mask, affine, zooms):
+    """
+    Volume, surface area, eccentricity and elongation of a region
+    :param mask: boolean mask (cropped)
+    :param affine: voxel to world affine of the crop
+    :param zooms: voxel size (mm)
+    :return: volume, surface area, eccentricity, elongation
+    """
+    count, _, cov = index_moments(mask)
+    if count == 0:
+        return 0., 0., np.nan, np.nan
+
+    # moments in mm (world space)
+    linear = affine[:3, :3]
+    eccentricity, elongation = shape_metrics(linear @ cov @ linear.T)
+
+    return count * float(np.prod(zooms[:3])), surface_area(mask, zooms), eccentricity, elongation
+
+
+def subj_geom(seg_file, brain_file=None, label=1):
+    """
+    Geometry of the right and left ventricles of a subject, computed within the bounding box of the segmentation.
+    Hemispheres are split at the world x of the brain mask centroid (segmentation centroid without a brain mask)
+    :param seg_file: ventricle segmentation
+    :param brain_file: brain mask
+    :param label: ventricle label
+    :return: Vol_R, Vol_L, SA_R, SA_L, ECC_R, ECC_L, Elong_R, Elong_L, HfB_Vol
+    """
+    seg = nib.load(seg_file)
+    zooms = [float(zoom) for zoom in seg.header.get_zooms()[:3]]
+    affine = seg.affine
+
+    mask = np.asanyarray(seg.dataobj) == label
+
+    hfb_vol = np.nan
+    mid_x = None
+    if brain_file is not None:
+        brain = nib.load(brain_file)
+        brain_count, brain_mean, _ = index_moments(np.asanyarray(brain.dataobj) > 0)
+        hfb_vol = brain_count * float(np.prod(brain.header.get_zooms()[:3]))
+        if brain_count:
+            mid_x = (brain.affine @ np.append(brain_mean, 1))[0]
+
+    crop = bbox(mask)
+    if crop is None:
+        return [0., 0., 0., 0., np.nan, np.nan, np.nan, np.nan, hfb_vol]
+
+    mask = mask[crop]
+    crop_affine = affine.copy()
+    crop_affine[:3, 3] = affine[:3, :3] @ [s.start for s in crop] + affine[:3, 3]
+
+    if mid_x is None:
+        _, seg_mean, _ = index_moments(mask)
+        mid_x = (crop_affine @ np.append(seg_mean, 1))[0]
+
+    # world x of each voxel of the crop (RAS+: right is towards +x)
+    world_x = sum(crop_affine[0, axis] * np.arange(size).reshape([-1 if a == axis else 1 for a in range(3)])
+                  for axis, size in enumerate(mask.shape)) + crop_affine[0, 3]
+    right = world_x > mid_x
+
+    vol_r, sa_r, ecc_r, elong_r = region_geom(mask & right, crop_affine, zooms)
+    vol_l, sa_l, ecc_l, elong_l = region_geom(mask & ~right, crop_affine, zooms)
+
+    return [vol_r, vol_l, sa_r, sa_l, ecc_r, ecc_l, elong_r, elong_l, hfb_vol]
+
+
+def geom_worker(inputs):
+    seg_file, brain_file, label = inputs
+
+    return subj_geom(seg_file, brain_file, label)
+
+
+def main(args):
+    parser = parsefn()
+    in_dir, out_csv, seg_name, brain_name, label, workers, formats = parse_inputs(parser, args)
+    check_formats(formats)
+
+    subjs = sorted(entry.name for entry in os.scandir(in_dir) if entry.is_dir())
+    segs = [find_mask(os.path.join(in_dir, subj), seg_name) for subj in subjs]
+
+    for subj, seg_file in zip(subjs, segs):
+        if seg_file is None:
+            print(subj, ' is missing')
+
+    found = [(subj, seg_file) for subj, seg_file in zip(subjs, segs) if seg_file is not None]
+    inputs = [(seg_file, find_mask(os.path.dirname(seg_file), brain_name), label) for _, seg_file in found]
+
+    rows = []
+    if inputs:
+        # results come back in the order of the subjects
+        pool = multiprocessing.Pool(min(workers, len(inputs)))
+        try:
+            results = pool.imap(geom_worker, inputs, chunksize=max(1, len(inputs) // (workers * 8)))
+
+            for (subj, seg_file), geom in zip(found, results):
+                print('reading ', subj)
+                rows.append([subj, seg_file] + geom)
+        finally:
+            pool.close()
+            pool.join()
+
+    df = pd.DataFrame(rows, columns=COLUMNS).set_index('Subject')
+    print('saving ventricular geometry csv')
+    save_table(df.round(3), out_csv, formats)
+    print(' saved to %s' % out_csv)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
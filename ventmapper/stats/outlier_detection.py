@@ -16,7 +16,7 @@ import sys
 proj_dir = sys.argv[1]
 
 # read geom dataframe
-list_of_files = glob.glob('%s/label_geom*' % proj_dir)
+list_of_files = glob.glob('%s/label_geom*.csv' % proj_dir)
 df = pd.read_csv(max(list_of_files, key=os.path.getctime))
 
 # paras
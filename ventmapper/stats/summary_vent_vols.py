@@ -6,10 +6,16 @@ import warnings
 import argcomplete
 import argparse
 import sys
-import glob
+import multiprocessing
+
+from ventmapper.stats.cache import TABLE_FORMATS, SubjectCache, check_formats, save_table
 
 warnings.filterwarnings("ignore")
 
+VENT_LABELS = [1]
+VENT_ABB = ['Vent']
+MASK_NAME = 'vent_pred.nii.gz'
+
 
 def parsefn():
     parser = argparse.ArgumentParser(description='Generates volumetric summary of ventricular segmentations',
@@ -22,6 +28,19 @@ def parsefn():
     required.add_argument('-o', '--out_csv', type=str, metavar='',
                           help='output stats ex: vent_vols_summary.csv', default='vent_volumes.csv')
 
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-w', '--workers', type=int, metavar='', default=multiprocessing.cpu_count(),
+                          help="number of processes reading the segmentations (default: %(default)s)")
+    optional.add_argument('-a', '--append', help="keep the subjects already in the output csv and only add new "
+                                                 "subjects (the csv is always saved)", action='store_true')
+    optional.add_argument('-f', '--formats', type=str, nargs='+', metavar='', default=['csv'], choices=TABLE_FORMATS,
+                          help="output formats: %s, columnar formats are saved next to the csv "
+                               "(default: %%(default)s)" % ', '.join(TABLE_FORMATS))
+    optional.add_argument('-nc', '--no_cache', help="read all segmentations instead of reusing the volumes of "
+                                                    "unchanged ones (cached next to the output csv)",
+                          action='store_true')
+
     return parser
 
 
@@ -32,46 +51,113 @@ def parse_inputs(parser, args):
 
     input_dir = args.in_dir
     out_csv = args.out_csv
+    workers = max(args.workers, 1)
+
+    return input_dir, out_csv, workers, args.append, args.formats, not args.no_cache
+
+
+def find_mask(subj_dir, mask_name=MASK_NAME):
+    """
+    Segmentation of a subject (first file ending with mask_name, in name order)
+    :return: mask file or None
+    """
+    try:
+        names = sorted(entry.name for entry in os.scandir(subj_dir)
+                       if entry.name.endswith(mask_name) and not entry.name.startswith('.'))
+    except OSError:
+        return None
+
+    return os.path.join(subj_dir, names[0]) if names else None
 
-    return input_dir, out_csv
+
+def label_counts(data, labels):
+    """
+    Number of voxels of each label, in a single pass for several labels
+    """
+    if len(labels) > 1 and data.dtype.kind in 'ui' and data.size and data.min() >= 0:
+        counts = np.bincount(data.ravel(), minlength=max(labels) + 1)
+        return [int(counts[label]) for label in labels]
+
+    return [int(np.count_nonzero(data == label)) for label in labels]
+
+
+def mask_volumes(mask_file, labels=VENT_LABELS):
+    """
+    Volume of each label of a segmentation, read in its on-disk dtype
+    :param mask_file: segmentation
+    :param labels: labels
+    :return: list of volumes (mm^3)
+    """
+    mask = nib.load(mask_file)
+    mask_data = np.asanyarray(mask.dataobj)
+    voxel_size = mask.header.get_zooms()
+    voxel_volume = voxel_size[0] * voxel_size[1] * voxel_size[2]
+
+    return [float(count * voxel_volume) for count in label_counts(mask_data, labels)]
 
 
 def main(args):
     parser = parsefn()
-    input_dir, out_csv = parse_inputs(parser, args)
-
-    vent_label = [1]
-    vent_abb = ['Vent']
-    mask_name = 'vent_pred.nii.gz'
-
-    subjs_dirs = [subj for subj in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, subj))]
-    index = []
-    my_index = []
-    volume = np.zeros([len(subjs_dirs), len(vent_abb)])
-    for i in range(0, len(subjs_dirs)):
-        my_index.append(i)
-        if glob.glob(os.path.join(input_dir, subjs_dirs[i], '*%s' % mask_name)):
-            # if os.path.isfile(os.path.join(input_dir, subjs_dirs[i], subjs_dirs[i] + mask_name)):
-            print('reading ', subjs_dirs[i])
-            index.append(subjs_dirs[i])
-            # mask = nib.load(os.path.join(input_dir, subjs_dirs[i], subjs_dirs[i] + mask_name))
-            mask = nib.load(glob.glob(os.path.join(input_dir, subjs_dirs[i], '*%s' % mask_name))[0])
-            mask_data = mask.get_data()
-            mask_hdr = mask.get_header()
-            voxel_size = mask_hdr.get_zooms()
-            voxel_volume = voxel_size[0] * voxel_size[1] * voxel_size[2]
-            for j in range(0, len(vent_label)):
-                volume[i, j] = np.shape(np.nonzero(mask_data == vent_label[j]))[1] * voxel_volume
-        else:
+    input_dir, out_csv, workers, append, formats, use_cache = parse_inputs(parser, args)
+
+    # appending diffs against the csv, so it is always kept up to date
+    if append and 'csv' not in formats:
+        formats = ['csv'] + formats
+    check_formats(formats)
+
+    subjs_dirs = [entry.name for entry in os.scandir(input_dir) if entry.is_dir()]
+
+    prev_df = None
+    if append and os.path.exists(out_csv):
+        # subject ids are dir names: read them as strings (ids like 1001 would be read as numbers)
+        prev_df = pd.read_csv(out_csv, index_col=0, dtype={'Subjects': str})
+        subjs_dirs = [subj for subj in subjs_dirs if subj not in prev_df.index]
+        print('appending %d new subjects to %s' % (len(subjs_dirs), out_csv))
+
+    masks = [find_mask(os.path.join(input_dir, subj)) for subj in subjs_dirs]
+
+    cache = SubjectCache('%s_cache.json' % os.path.splitext(out_csv)[0], params=dict(labels=VENT_LABELS),
+                         enabled=use_cache)
+    volumes = [cache.lookup(mask) if mask is not None else None for mask in masks]
+    to_read = [i for i, mask in enumerate(masks) if mask is not None and volumes[i] is None]
+
+    # only new or changed segmentations are read, results come back in the order of the subjects
+    if to_read:
+        pool = multiprocessing.Pool(min(workers, len(to_read)))
+        try:
+            results = pool.imap(mask_volumes, [masks[i] for i in to_read],
+                                chunksize=max(1, len(to_read) // (workers * 8)))
+
+            for i, subj_vols in zip(to_read, results):
+                print('reading ', subjs_dirs[i])
+                volumes[i] = subj_vols
+                cache.store(masks[i], subj_vols)
+        finally:
+            pool.close()
+            pool.join()
+
+    for i, mask in enumerate(masks):
+        if mask is None:
             print(subjs_dirs[i], ' is missing')
 
-    cols = ['%s_Volume' % vent_abb[0]]
+    print('%d segmentations read, %d unchanged' % (len(to_read), sum(mask is not None for mask in masks) -
+                                                     len(to_read)))
+    cache.save(prune=prev_df is None)
+
+    cols = ['%s_Volume' % VENT_ABB[0]]
 
+    volume = np.array([subj_vols if subj_vols is not None else [0] * len(VENT_ABB) for subj_vols in volumes],
+                      dtype=float).reshape(-1, len(VENT_ABB))
     df = pd.DataFrame(volume, index=subjs_dirs, columns=cols)
     df.index.name = 'Subjects'
     df = df[(df.T != 0).any()]
+
+    if prev_df is not None:
+        df = pd.concat([prev_df, df.round(3)])
+        df.index.name = 'Subjects'
+
     print('saving ventricular volumetric csv')
-    df.round(3).to_csv(out_csv)
+    save_table(df.round(3), out_csv, formats)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argcomplete
+import argparse
+import contextlib
+import glob
+import io
+import json
+import nibabel as nib
+import numpy as np
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from termcolor import colored
+
+from ventmapper import ROOT_DIR
+from ventmapper.utils import resources
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+TEST_CASE_DIR = os.path.abspath(os.path.join(ROOT_DIR, "..", "data", "test_case"))
+
+# cli calls timed by the startup benchmark and heavy modules they should not load
+STARTUP_CALLS = [['-v'], ['stats_vent', '-h'], ['seg_vent', '-h']]
+HEAVY_MODULES = ['tensorflow', 'keras', 'keras_contrib', 'nipype', 'nilearn', 'PyQt5']
+
+STARTUP_SCRIPT = '''
+import json, sys
+from ventmapper.cli import main
+try:
+    main(%r)
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps([module for module in %r if module in sys.modules]))
+'''
+
+STAGES = ['orient', 'mask', 'standardize', 'trim', 'resample', 'predict', 'resample_back', 'qc', 'bias_corr',
+          'volume']
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage='%(prog)s [ -s x y z ] [ -r repeats ] \n\n'
+                                           "Benchmark time and peak memory of each pipeline stage on the bundled "
+                                           "test case and synthetic volumes")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-d', '--datasets', type=str, nargs='+', metavar='', default=['test_case', 'synthetic'],
+                          choices=['test_case', 'synthetic', 'startup'],
+                          help="datasets to run on, startup times the cli startup of lightweight calls "
+                               "(default: %(default)s)")
+    optional.add_argument('-s', '--shape', type=int, nargs=3, metavar='', default=[256, 256, 176],
+                          help="shape of the synthetic volumes (default: %(default)s)")
+    optional.add_argument('-r', '--repeats', type=int, metavar='', default=3,
+                          help="number of runs of each stage (default: %(default)s)")
+    optional.add_argument('-st', '--stages', type=str, nargs='+', metavar='', default=STAGES, choices=STAGES,
+                          help="stages to run (default: all)")
+    optional.add_argument('-e', '--engines', type=str, nargs='+', metavar='', default=['c3d', 'numpy'],
+                          choices=['c3d', 'numpy'],
+                          help="engines of the mask, standardize and trim stages (default: %(default)s)")
+    optional.add_argument('-o', '--out_json', type=str, metavar='', default='bench.json',
+                          help="output json of stage statistics (default: %(default)s)")
+    optional.add_argument('-v', '--verbose', help="show the output of the stages", action='store_true')
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    return args.datasets, args.shape, max(args.repeats, 1), args.stages, args.engines, args.out_json, args.verbose
+
+
+def make_synthetic(out_dir, shape, seed=0):
+    """
+    Create a synthetic t1, brain mask and ventricle segmentation
+    :param out_dir: output dir
+    :param shape: volume shape
+    :return: dict of t1, mask and seg files
+    """
+    from scipy import ndimage
+
+    rng = np.random.RandomState(seed)
+    affine = np.diag([1., 1., 1., 1.])
+
+    grid = np.ogrid[tuple(slice(0, dim) for dim in shape)]
+    center = [dim / 2. for dim in shape]
+
+    def ellipsoid(radii, offset=(0, 0, 0)):
+        return sum(((g - c - o) / r) ** 2 for g, c, o, r in zip(grid, center, offset, radii)) <= 1
+
+    mask = ellipsoid([dim * 0.4 for dim in shape])
+    seg = ellipsoid([dim * 0.05 for dim in shape], (0, -shape[1] * 0.05, 0)) | \
+        ellipsoid([dim * 0.05 for dim in shape], (0, shape[1] * 0.05, 0))
+
+    t1 = ndimage.gaussian_filter(rng.standard_normal(shape).astype(np.float32), 2) * 50 + 300
+    t1[mask] += 400
+    t1[seg] -= 500
+
+    files = {}
+    for name, data in [('t1', t1), ('mask', mask.astype(np.uint8)), ('seg', seg.astype(np.uint8))]:
+        files[name] = os.path.join(out_dir, 'synthetic_%s.nii.gz' % name)
+        nib.save(nib.Nifti1Image(data, affine), files[name])
+
+    return files
+
+
+def test_case_inputs():
+    """
+    Inputs found in the bundled test case (t1 and mask only if present)
+    """
+    files = {}
+    segs = glob.glob(os.path.join(TEST_CASE_DIR, '*pred_bin.nii.gz'))
+    if segs:
+        files['seg'] = segs[0]
+    for name, pattern in [('t1', '*mprage.nii.gz'), ('mask', '*brain_mask.nii.gz')]:
+        found = glob.glob(os.path.join(TEST_CASE_DIR, pattern))
+        if found:
+            files[name] = found[0]
+
+    return files
+
+
+def get_stages(engines):
+    """
+    Stage functions in pipeline order: name, label, required inputs (tuples: any of), required executables,
+    function(ctx, work_dir). Functions add their outputs to ctx for the following stages
+    """
+    def orient_stage(ctx, work_dir):
+        from ventmapper.segment.ventmapper import check_orient
+        in_file = ctx.get('t1', ctx.get('seg'))
+        ctx['t1_img'], _ = check_orient(in_file, 'RPI', 'LPI', os.path.join(work_dir, 'std_orient.nii.gz'))
+
+    def mask_c3d(ctx, work_dir):
+        from ventmapper.segment.ventmapper import image_mask
+        ctx['masked'] = os.path.join(work_dir, 'masked.nii.gz')
+        image_mask(ctx['t1'], ctx['mask'], ctx['masked'])
+
+    def standardize_c3d(ctx, work_dir):
+        from ventmapper.segment.ventmapper import image_standardize
+        ctx['std'] = os.path.join(work_dir, 'masked_standardized.nii.gz')
+        image_standardize(ctx['masked'], ctx['mask'], ctx['std'])
+
+    def trim_c3d(ctx, work_dir):
+        from ventmapper.segment.ventmapper import trim
+        ctx['cropped'] = os.path.join(work_dir, 'masked_standardized_cropped.nii.gz')
+        trim(ctx['std'], ctx['cropped'], voxels=1)
+
+    def mask_numpy(ctx, work_dir):
+        from ventmapper.preprocess import inmemory
+        ctx['mask_data'] = np.asanyarray(nib.load(ctx['mask']).dataobj)
+        ctx['masked_data'] = inmemory.mask_data(np.asanyarray(nib.load(ctx['t1']).dataobj), ctx['mask_data'])
+
+    def standardize_numpy(ctx, work_dir):
+        from ventmapper.preprocess import inmemory
+        ctx['std_data'] = inmemory.standardize_data(ctx['masked_data'], ctx['mask_data'])
+
+    def trim_numpy(ctx, work_dir):
+        from ventmapper.preprocess import inmemory
+        bbox = inmemory.get_bbox(ctx['std_data'], voxels=1)
+        ctx['cropped_img'] = inmemory.crop_img(ctx['std_data'], nib.load(ctx['t1']).affine, bbox)
+
+    def resample_stage(ctx, work_dir):
+        from ventmapper.segment.ventmapper import resample
+        img = ctx['cropped_img'] if 'cropped_img' in ctx else nib.load(ctx['cropped'])
+        ctx['res'] = resample(img, [128, 128, 128])
+
+    def predict_stage(ctx, work_dir):
+        from ventmapper.deep.predict import run_test_batch
+        from ventmapper.segment.ventmapper import get_model_files
+        model_json, model_weights = get_model_files('vent_t1only')
+        test_data = np.asarray(ctx['res'].dataobj, dtype=np.float32)[np.newaxis, np.newaxis]
+        ctx['pred'] = run_test_batch(test_data, model_json, model_weights, [ctx['res'].affine],
+                                     output_label_map=True, labels=1, model_name='vent_t1only')[0]
+
+    def resample_back_stage(ctx, work_dir):
+        from ventmapper.preprocess import inmemory
+        # without a model, the resampled t1 stands in for the probability map
+        pred = ctx.get('pred', ctx['res'])
+        t1_img = ctx.get('t1_img', nib.load(ctx['t1']))
+        inmemory.resample_back(pred, t1_img, threshold=0.5)
+
+    def qc_stage(ctx, work_dir):
+        from ventmapper.qc import seg_qc
+        seg = os.path.join(work_dir, 'seg.nii.gz')
+        shutil.copy(ctx['seg'], seg)
+        seg_qc.main(['-i', ctx['t1'], '-s', seg, '-g', '2', '-m', '40'])
+
+    def bias_corr_stage(ctx, work_dir):
+        from ventmapper.preprocess import biascorr
+        biascorr.main(['-i', ctx['t1'], '-m', ctx['mask'], '-o', os.path.join(work_dir, 'n4.nii.gz')])
+
+    def volume_stage(ctx, work_dir):
+        from ventmapper.stats import summary_vent_vols
+        cohort_dir = os.path.join(work_dir, 'cohort')
+        subj_dir = os.path.join(cohort_dir, 'subj')
+        if not os.path.exists(subj_dir):
+            os.makedirs(subj_dir)
+            shutil.copy(ctx['seg'], os.path.join(subj_dir, 'subj_vent_pred.nii.gz'))
+        summary_vent_vols.main(['-i', cohort_dir, '-o', os.path.join(work_dir, 'vent_volumes.csv')])
+
+    stages = [('orient', 'orient', [('t1', 'seg')], [], orient_stage)]
+    for engine in engines:
+        if engine == 'c3d':
+            stages += [('mask', 'mask_c3d', ['t1', 'mask'], ['c3d'], mask_c3d),
+                       ('standardize', 'standardize_c3d', ['masked'], ['c3d'], standardize_c3d),
+                       ('trim', 'trim_c3d', ['std'], ['c3d'], trim_c3d)]
+        else:
+            stages += [('mask', 'mask_numpy', ['t1', 'mask'], [], mask_numpy),
+                       ('standardize', 'standardize_numpy', ['masked_data'], [], standardize_numpy),
+                       ('trim', 'trim_numpy', ['std_data'], [], trim_numpy)]
+
+    stages += [('resample', 'resample', [('cropped', 'cropped_img')], [], resample_stage),
+               ('predict', 'predict', ['res'], [], predict_stage),
+               ('resample_back', 'resample_back', ['res', 't1'], [], resample_back_stage),
+               ('qc', 'qc', ['t1', 'seg'], ['c3d', 'CreateTiledMosaic'], qc_stage),
+               ('bias_corr', 'bias_corr', ['t1', 'mask'], ['N4BiasFieldCorrection'], bias_corr_stage),
+               ('volume', 'volume', ['seg'], [], volume_stage)]
+
+    return stages
+
+
+def run_stage(fn, ctx, work_dir, repeats, verbose=False):
+    """
+    Run a stage several times, measuring wall time and peak memory of each run
+    :return: list of wall times, peak rss of this process, lifetime max rss of child processes if the stage's
+             subprocesses raised it (bytes, else None)
+    """
+    times = []
+    peak = 0
+    children_peak = resources.children_peak_rss()
+
+    for r in range(repeats):
+        resources.reset_peak_rss()
+        start = time.time()
+
+        if verbose:
+            fn(ctx, work_dir)
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                fn(ctx, work_dir)
+
+        times.append(time.time() - start)
+        peak = max(peak, resources.peak_rss())
+
+    return times, peak, resources.children_peak_since(children_peak)
+
+
+def run_dataset(name, inputs, stages, repeats, verbose=False):
+    """
+    Run the benchmarked stages on a dataset, skipping stages with missing inputs or executables
+    :return: list of stage statistics
+    """
+    results = []
+    ctx = dict(inputs)
+
+    with tempfile.TemporaryDirectory(prefix='ventmapper_bench_') as work_dir:
+        for stage, label, required, executables, fn in stages:
+            required = [key if isinstance(key, tuple) else (key,) for key in required]
+            missing = ['/'.join(keys) for keys in required if not any(key in ctx for key in keys)]
+            missing += [exe for exe in executables if shutil.which(exe) is None]
+
+            if missing:
+                print(" %s / %s: skipped (missing %s)" % (name, label, ', '.join(missing)))
+                continue
+
+            try:
+                times, peak, children_max = run_stage(fn, ctx, work_dir, repeats, verbose)
+            except (Exception, SystemExit) as error:
+                print(" %s / %s: failed (%s)" % (name, label, str(error).strip().splitlines()[-1] if str(error)
+                                                 else type(error).__name__))
+                continue
+
+            result = {'dataset': name, 'stage': label, 'runs': len(times),
+                      'median_s': float(np.median(times)), 'p95_s': float(np.percentile(times, 95)),
+                      'peak_rss_mb': peak / 2. ** 20,
+                      'children_max_rss_mb': children_max / 2. ** 20 if children_max is not None else None}
+            results.append(result)
+            print(" %s / %s: %.3fs (p95 %.3fs), peak rss %.0f MB" % (name, label, result['median_s'],
+                                                                      result['p95_s'], result['peak_rss_mb']))
+
+    return results
+
+
+def run_startup(repeats, verbose=False):
+    """
+    Time the startup of lightweight cli calls in a fresh interpreter, listing the heavy modules each loads
+    :return: list of call statistics
+    """
+    results = []
+
+    for call in STARTUP_CALLS:
+        label = ' '.join(call)
+        times = []
+
+        for r in range(repeats):
+            start = time.time()
+            proc = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT % (call, HEAVY_MODULES)],
+                                  stdout=None if verbose else subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                  universal_newlines=True)
+            times.append(time.time() - start)
+
+        try:
+            loaded = json.loads(proc.stderr.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            print(" startup / %s: failed (%s)" % (label, proc.stderr.strip().splitlines()[-1] if proc.stderr.strip()
+                                                  else proc.returncode))
+            continue
+
+        result = {'dataset': 'startup', 'stage': label, 'runs': len(times),
+                  'median_s': float(np.median(times)), 'p95_s': float(np.percentile(times, 95)),
+                  'heavy_modules': loaded}
+        results.append(result)
+        print(" startup / %s: %.3fs (p95 %.3fs), heavy modules: %s" % (label, result['median_s'], result['p95_s'],
+                                                                        ', '.join(loaded) if loaded else 'none'))
+
+    return results
+
+
+def main(args):
+    parser = parsefn()
+    datasets, shape, repeats, stage_names, engines, out_json, verbose = parse_inputs(parser, args)
+
+    stages = [stage for stage in get_stages(engines) if stage[0] in stage_names]
+    results = []
+
+    for dataset in datasets:
+        print(colored("\n benchmarking %s" % dataset, 'green'))
+
+        if dataset == 'test_case':
+            results += run_dataset(dataset, test_case_inputs(), stages, repeats, verbose)
+        elif dataset == 'startup':
+            results += run_startup(repeats, verbose)
+        else:
+            with tempfile.TemporaryDirectory(prefix='ventmapper_synthetic_') as data_dir:
+                inputs = make_synthetic(data_dir, shape)
+                results += run_dataset('synthetic_%s' % 'x'.join(map(str, shape)), inputs, stages, repeats,
+                                       verbose)
+
+    with open(out_json, 'w') as json_file:
+        json.dump({'shape': shape, 'repeats': repeats, 'stages': results}, json_file, indent=2)
+
+    if results:
+        import pandas as pd
+        df = pd.DataFrame(results).set_index(['dataset', 'stage'])
+        print("\n%s" % df.round(3).to_string())
+
+    print("\n saved stage statistics to %s" % out_json)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
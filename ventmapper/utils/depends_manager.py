@@ -1,48 +1,138 @@
+import hashlib
+import json
 import os
-import sys
+import shutil
 import subprocess
+import sys
 
 from ventmapper import DEPENDS_DIR
 
+# required tools: dir of the bundled install (in DEPENDS_DIR), arguments printing the version
+TOOLS = dict(ANTS=("ants", ['--version']),
+             c3d=("c3d/bin", ['-version']))
+
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'ventmapper', 'depends.json')
+MAX_CACHED = 16  # PATHs remembered
+
+
+def tool_version(exe, version_args):
+    """
+    Version of a tool (first line of its version output)
+    :return: version or 'unknown'
+    """
+    try:
+        out = subprocess.run([exe] + version_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return 'unknown'
+
+    lines = [line.strip() for line in out.splitlines() if line.strip()]
+
+    return lines[0] if lines else 'unknown'
+
+
+def cache_key(path_env):
+    return hashlib.sha1(json.dumps([path_env, DEPENDS_DIR]).encode('utf-8')).hexdigest()
+
+
+def read_cache(cache_file=CACHE_FILE):
+    try:
+        with open(cache_file, 'r') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache(cache, cache_file=CACHE_FILE):
+    # written to a temporary file first so concurrent runs never read a partial cache
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        with open(tmp_file, 'w') as json_file:
+            json.dump(cache, json_file, indent=2)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+
+
+def is_valid(tools):
+    # cached locations are only trusted while every tool is still there
+    return all(tool['path'] is not None and os.access(tool['path'], os.X_OK) for tool in tools.values())
+
+
+def resolve_tools(refresh=False, cache_file=CACHE_FILE):
+    """
+    Locate the required tools on PATH, falling back on their bundled install in DEPENDS_DIR.
+    Locations and versions are cached, keyed by PATH and DEPENDS_DIR
+    :param refresh: ignore the cached locations
+    :param cache_file: cache file
+    :return: dict of tool: path (None if not found), dir added to PATH (None if already on it), version
+    """
+    path_env = os.environ.get('PATH', '')
+    key = cache_key(path_env)
+
+    cache = read_cache(cache_file)
+    entry = cache.get(key)
+    if entry is not None and not refresh and is_valid(entry['tools']):
+        return entry['tools']
+
+    tools = {}
+    for command, (subdir, version_args) in TOOLS.items():
+        tool_dir = os.path.join(DEPENDS_DIR, subdir)
+        added_dir = None
+
+        exe = shutil.which(command, path=path_env)
+        if exe is None and os.path.isdir(tool_dir):
+            exe = shutil.which(command, path=tool_dir)
+            added_dir = tool_dir
+
+        tools[command] = dict(path=exe, added_dir=added_dir,
+                              version=tool_version(exe, version_args) if exe else None)
+
+    cache.pop(key, None)
+    cache[key] = dict(PATH=path_env, DEPENDS_DIR=DEPENDS_DIR, tools=tools)
+    write_cache(dict(list(cache.items())[-MAX_CACHED:]), cache_file)
+
+    return tools
+
+
 class add_paths():
     """ Context manager to add necessary paths to PATH environment variable. Files will be removed after use
     """
     def __init__(self):
-        # create dictionary of paths that will temporarily be added to the PATH env variable
-        self.command_paths = dict(ANTS=os.path.join(DEPENDS_DIR, "ants"),
-                                  c3d=os.path.join(DEPENDS_DIR, "c3d/bin"))
-        self.added_paths = []  # empty list for all paths to be added
+        self.saved_env = {}  # PATH and ANTSPATH before entering
 
     def __enter__(self):
         ''' Add paths to PATH environment variable prior to running the function.
         '''
-        for command in self.command_paths.keys():
-            try:
-                subprocess.check_call(['which', command])
-            except subprocess.CalledProcessError:  # if the command doesnt exist, add it to the path
-                if os.path.isdir(self.command_paths[command]):
-                    os.environ['PATH'] += os.pathsep + self.command_paths[command]
-                    self.added_paths.append(self.command_paths[command])
-                else:
-                    print('ERROR: %s is required to continue. Please install using the instructions on https://ventmapp3r.readthedocs.io/en/latest/install-local.html' \
-                        % (command))
-                    sys.exit()
+        tools = resolve_tools()
+
+        missing = [command for command, tool in tools.items() if tool['path'] is None]
+        if missing:
+            print('ERROR: %s is required to continue. Please install using the instructions on '
+                  'https://ventmapp3r.readthedocs.io/en/latest/install-local.html' % ', '.join(missing))
+            sys.exit()
+
+        self.saved_env = {var: os.environ.get(var) for var in ['PATH', 'ANTSPATH']}
+
+        for command, tool in tools.items():
+            if tool['added_dir'] and tool['added_dir'] not in os.environ['PATH'].split(os.pathsep):
+                os.environ['PATH'] += os.pathsep + tool['added_dir']
 
         # if ants is added, we have to include it in ANTSPATH
-        if self.command_paths['ANTS'] in self.added_paths:
-            if 'ANTSPATH' in os.environ.keys():
-                os.environ['ANTSPATH'] += os.pathsep + self.command_paths['ANTS']
+        ants_dir = tools['ANTS']['added_dir']
+        if ants_dir:
+            if os.environ.get('ANTSPATH'):
+                os.environ['ANTSPATH'] += os.pathsep + ants_dir
             else:
-                os.environ['ANTSPATH'] = self.command_paths['ANTS']
+                os.environ['ANTSPATH'] = ants_dir
 
+        return tools
 
     def __exit__(self, exc_type, exc_value, traceback):
-        for path in self.added_paths:  # remove all added PATH variables
-            try:
-                os.environ['PATH'] = os.environ['PATH'].replace(path, '')
-            except ValueError:
-                pass
-
-        # remove ANTSPATH if it was set
-        if 'ANTSPATH' in os.environ.keys() and self.command_paths['ANTS'] in self.added_paths:
-            os.environ['ANTSPATH']  = os.environ['PATH'].replace(self.command_paths['ANTS'], '')
+        # restore PATH and ANTSPATH
+        for var, value in self.saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argcomplete
+import argparse
+import sys
+from termcolor import colored
+
+from ventmapper import DEPENDS_DIR
+from ventmapper.utils.depends_manager import CACHE_FILE, resolve_tools
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage='%(prog)s [ -r ] \n\n'
+                                           "Report the location and version of the required tools")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-r', '--refresh', help="locate the tools again instead of using the cached locations",
+                          action='store_true')
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    return args.refresh
+
+
+def main(args):
+    parser = parsefn()
+    refresh = parse_inputs(parser, args)
+
+    tools = resolve_tools(refresh)
+
+    print("\n depends dir: %s" % DEPENDS_DIR)
+    print(" cache: %s\n" % CACHE_FILE)
+
+    for command, tool in sorted(tools.items()):
+        if tool['path'] is None:
+            print(colored(" %-6s missing" % command, 'red'))
+        else:
+            source = 'bundled' if tool['added_dir'] else 'PATH'
+            print(colored(" %-6s %s (%s, %s)" % (command, tool['path'], source, tool['version']), 'green'))
+
+    missing = [command for command, tool in tools.items() if tool['path'] is None]
+    if missing:
+        print("\n install %s using the instructions on "
+              "https://ventmapp3r.readthedocs.io/en/latest/install-local.html" % ', '.join(missing))
+
+    return 1 if missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,269 @@
+#! /usr/bin/env python3
+# coding: utf-8
+
+import codecs
+import multiprocessing
+import os
+import shlex
+import signal
+import sys
+import time
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+from ventmapper.utils.trace import PROGRESS_ENV, PROGRESS_PREFIX
+
+# runs the cli in its own process group so cancelling a job also stops the tools it started (c3d, ants)
+JOB_SCRIPT = "import os, sys\n" \
+             "try:\n" \
+             "    os.setsid()\n" \
+             "except (AttributeError, OSError):\n" \
+             "    pass\n" \
+             "from ventmapper.cli import main\n" \
+             "main(sys.argv[1:])\n"
+
+MAX_LOG_LINES = 5000
+COLUMNS = ['job', 'status', 'stage', 'progress', 'elapsed']
+
+
+class Job(object):
+    """ A queued cli call, with its process and progress
+    """
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.status = 'queued'
+        self.stage = ''
+        self.stages_done = 0
+        self.process = None
+        self.start = None
+        self.end = None
+        self.log = []
+        self.partial = ''  # output after the last complete line
+        # characters can be split across reads
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def elapsed(self):
+        if self.start is None:
+            return 0
+        return (self.end if self.end else time.time()) - self.start
+
+
+class JobQueue(QtWidgets.QWidget):
+    """ Panel of the gui jobs: runs at most max_jobs at once in background processes, following the stages
+    they report, and lets them be cancelled
+    """
+    def __init__(self, max_jobs=1, parent=None):
+        QtWidgets.QWidget.__init__(self, parent)
+        self.setWindowTitle('VentMapp3r jobs')
+        self.resize(700, 300)
+
+        self.jobs = []
+
+        self.table = QtWidgets.QTableWidget(0, len(COLUMNS))
+        self.table.setHorizontalHeaderLabels(COLUMNS)
+        self.table.horizontalHeader().setSectionResizeMode(QtWidgets.QHeaderView.Stretch)
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.cellDoubleClicked.connect(lambda row, col: self.show_log(self.jobs[row]))
+
+        self.max_jobs = QtWidgets.QSpinBox()
+        self.max_jobs.setRange(1, multiprocessing.cpu_count())
+        self.max_jobs.setValue(max_jobs)
+        self.max_jobs.setToolTip('number of jobs running at once (each job uses several cpus)')
+        self.max_jobs.valueChanged.connect(self.schedule)
+
+        cancel = QtWidgets.QPushButton('Cancel')
+        cancel.clicked.connect(self.cancel_selected)
+        clear = QtWidgets.QPushButton('Clear finished')
+        clear.clicked.connect(self.clear_finished)
+
+        buttons = QtWidgets.QHBoxLayout()
+        buttons.addWidget(QtWidgets.QLabel('max running jobs'))
+        buttons.addWidget(self.max_jobs)
+        buttons.addStretch()
+        buttons.addWidget(cancel)
+        buttons.addWidget(clear)
+
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.table)
+        layout.addLayout(buttons)
+
+        self.log_windows = []
+
+        # elapsed times of running jobs
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(1000)
+
+    def submit(self, name, cmd):
+        """
+        Queue a cli call
+        :param name: job name (ex: seg_vent)
+        :param cmd: command (ex: ventmapper seg_vent --t1w t1.nii.gz)
+        :return: job
+        """
+        args = shlex.split(cmd)
+        if args and os.path.basename(args[0]) == 'ventmapper':
+            args = args[1:]
+
+        job = Job(name, args)
+        self.jobs.append(job)
+
+        row = self.table.rowCount()
+        self.table.insertRow(row)
+        for col in range(len(COLUMNS)):
+            self.table.setItem(row, col, QtWidgets.QTableWidgetItem())
+        self.table.setCellWidget(row, COLUMNS.index('progress'), QtWidgets.QProgressBar())
+        self.table.item(row, 0).setToolTip(cmd)
+
+        self.update_row(job)
+        self.schedule()
+
+        return job
+
+    def schedule(self):
+        running = sum(job.status == 'running' for job in self.jobs)
+
+        for job in self.jobs:
+            if running >= self.max_jobs.value():
+                break
+            if job.status == 'queued':
+                self.start_job(job)
+                running += 1
+
+    def start_job(self, job):
+        process = QtCore.QProcess(self)
+        process.setProcessChannelMode(QtCore.QProcess.MergedChannels)
+
+        env = QtCore.QProcessEnvironment.systemEnvironment()
+        env.insert(PROGRESS_ENV, '1')
+        env.insert('PYTHONUNBUFFERED', '1')
+        process.setProcessEnvironment(env)
+
+        process.readyReadStandardOutput.connect(lambda: self.read_output(job))
+        process.finished.connect(lambda code, exit_status: self.finished(job, code))
+        process.errorOccurred.connect(lambda error: self.failed_to_start(job, error))
+
+        job.process = process
+        job.status = 'running'
+        job.start = time.time()
+        process.start(sys.executable, ['-c', JOB_SCRIPT] + job.args)
+
+        self.update_row(job)
+
+    def read_output(self, job, final=False):
+        out = job.partial + job.decoder.decode(bytes(job.process.readAllStandardOutput()), final=final)
+
+        # chunks can end within a line: keep it until the rest is read
+        lines = out.split('\n')
+        job.partial = lines.pop()
+        self.parse_lines(job, lines)
+
+    def parse_lines(self, job, lines):
+        for line in lines:
+            line = line.rstrip('\r')
+            fields = line.split(' ', 2)
+
+            if fields[0] != PROGRESS_PREFIX:
+                job.log.append(line)
+            elif len(fields) == 3 and fields[1] == 'start':
+                job.stage = fields[2]
+            elif len(fields) == 3 and fields[1] in ['done', 'failed']:
+                job.stages_done += 1
+            # malformed progress lines are skipped
+
+        del job.log[:-MAX_LOG_LINES]
+        self.update_row(job)
+
+    def finished(self, job, code):
+        # output left unread when the process exited, and its last line if it had no newline
+        if job.process is not None:
+            self.read_output(job, final=True)
+        if job.partial:
+            self.parse_lines(job, [job.partial])
+            job.partial = ''
+
+        job.end = time.time()
+        if job.status == 'running':
+            job.status = 'done' if code == 0 else 'failed'
+        job.stage = ''
+        job.process = None
+
+        self.update_row(job)
+        self.schedule()
+
+    def failed_to_start(self, job, error):
+        if error == QtCore.QProcess.FailedToStart:
+            job.status = 'failed'
+            job.log.append('failed to start: %s' % job.process.errorString())
+            self.finished(job, 1)
+
+    def cancel(self, job):
+        if job.status == 'queued':
+            job.status = 'cancelled'
+            self.update_row(job)
+
+        elif job.status == 'running':
+            job.status = 'cancelled'
+            pid = job.process.processId()
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except (AttributeError, OSError):
+                job.process.terminate()
+
+            # kill if it did not stop
+            process = job.process
+            QtCore.QTimer.singleShot(10000, lambda: process.kill() if process.state() else None)
+            self.update_row(job)
+
+    def cancel_selected(self):
+        for row in sorted(set(index.row() for index in self.table.selectedIndexes())):
+            self.cancel(self.jobs[row])
+
+    def clear_finished(self):
+        for row in reversed(range(len(self.jobs))):
+            if self.jobs[row].status in ['done', 'failed', 'cancelled'] and self.jobs[row].process is None:
+                self.table.removeRow(row)
+                del self.jobs[row]
+
+    def update_row(self, job):
+        row = self.jobs.index(job)
+
+        self.table.item(row, 0).setText(job.name)
+        self.table.item(row, 1).setText(job.status)
+        self.table.item(row, 2).setText('%s (%d stages done)' % (job.stage, job.stages_done) if job.stage
+                                        else '%d stages done' % job.stages_done if job.stages_done else '')
+        self.table.item(row, 4).setText(time.strftime('%H:%M:%S', time.gmtime(job.elapsed())) if job.start else '')
+
+        bar = self.table.cellWidget(row, COLUMNS.index('progress'))
+        if job.status == 'running':
+            bar.setRange(0, 0)  # busy: the number of stages of a job is not known ahead
+        else:
+            bar.setRange(0, 1)
+            bar.setValue(1 if job.status == 'done' else 0)
+
+        color = {'done': QtCore.Qt.darkGreen, 'failed': QtCore.Qt.red, 'cancelled': QtCore.Qt.gray}
+        self.table.item(row, 1).setForeground(QtGui.QBrush(color.get(job.status, QtCore.Qt.black)))
+
+    def refresh(self):
+        for job in self.jobs:
+            if job.status == 'running':
+                self.update_row(job)
+
+    def show_log(self, job):
+        log = QtWidgets.QPlainTextEdit()
+        log.setReadOnly(True)
+        log.setWindowTitle('%s: ventmapper %s' % (job.name, ' '.join(job.args)))
+        log.setPlainText('\n'.join(job.log))
+        log.resize(800, 500)
+
+        self.log_windows[:] = [window for window in self.log_windows if window.isVisible()] + [log]
+        log.show()
+
+    def shutdown(self):
+        # stop the jobs when the gui quits, their tools would otherwise keep running
+        for job in self.jobs:
+            self.cancel(job)
+        for job in self.jobs:
+            if job.process is not None:
+                job.process.waitForFinished(5000)
@@ -47,7 +47,33 @@ def parseargs():
     return title, vols, dirs, fields, checks, helpfun
 
 
-def OptsMenu(title, vols=None, dirs=None, fields=None, checks=None, helpfun=None):
+def parser_fields(parser, vols=None, dirs=None):
+    """
+    Options of a subcommand parser for the option widgets: flags get checkboxes, other options line edits
+    :param parser: subcommand parser
+    :param vols: options selected with a file dialog
+    :param dirs: options selected with a dir dialog
+    :return: vols, dirs, fields, checks, tooltips (help of each option)
+    """
+    vols, dirs = list(vols or []), list(dirs or [])
+    fields, checks, tooltips = [], [], {}
+
+    for action in parser._actions:
+        if not action.option_strings or action.dest == 'help':
+            continue
+
+        name = max(action.option_strings, key=len).lstrip('-')
+        tooltips[name] = (action.help or '').replace('%(default)s', str(action.default)).replace('%%', '%')
+
+        if action.nargs == 0:
+            checks.append(name)
+        elif name not in vols and name not in dirs:
+            fields.append(name)
+
+    return vols, dirs, fields, checks, tooltips
+
+
+def OptsMenu(title, vols=None, dirs=None, fields=None, checks=None, helpfun=None, tooltips=None, on_run=None):
     # create GUI
     main = QtWidgets.QMainWindow()
 
@@ -64,6 +90,7 @@ def OptsMenu(title, vols=None, dirs=None, fields=None, checks=None, helpfun=None
     buttons = OrderedDict()
     labels = OrderedDict()
     flags = OrderedDict()
+    tooltips = tooltips if tooltips else {}
 
     if dirs:
 
@@ -71,6 +98,7 @@ def OptsMenu(title, vols=None, dirs=None, fields=None, checks=None, helpfun=None
             # Create buttons for vols
             labels["%s" % indir] = QtWidgets.QLabel('No Dir selected')
             buttons["%s" % indir] = QtWidgets.QPushButton('Select %s' % indir)
+            buttons["%s" % indir].setToolTip(tooltips.get(indir, ''))
 
             # Layout for widgets
             layout.addRow(labels["%s" % indir], buttons["%s" % indir])
@@ -83,6 +111,7 @@ def OptsMenu(title, vols=None, dirs=None, fields=None, checks=None, helpfun=None
             # Create buttons for vols
             labels["%s" % vol] = QtWidgets.QLabel('No file selected')
             buttons["%s" % vol] = QtWidgets.QPushButton('Select %s' % vol)
+            buttons["%s" % vol].setToolTip(tooltips.get(vol, ''))
 
             # Layout for widgets
             layout.addRow(labels["%s" % vol], buttons["%s" % vol])
@@ -95,6 +124,7 @@ def OptsMenu(title, vols=None, dirs=None, fields=None, checks=None, helpfun=None
             # Create inputs (line edts)
             linedits["%s" % field] = QtWidgets.QLineEdit()
             linedits["%s" % field].setAlignment(QtCore.Qt.AlignRight)
+            linedits["%s" % field].setToolTip(tooltips.get(field, ''))
 
             # Layout for widgets
             layout.addRow("%s" % field, linedits["%s" % field])
@@ -105,6 +135,7 @@ def OptsMenu(title, vols=None, dirs=None, fields=None, checks=None, helpfun=None
             horiz_box = QtWidgets.QHBoxLayout()
             buttons[checkbox] = QtWidgets.QCheckBox()
             buttons[checkbox].setText(checkbox)
+            buttons[checkbox].setToolTip(tooltips.get(checkbox, ''))
             flags[checkbox] = False
             buttons[checkbox].stateChanged.connect(lambda: checkbox_state(buttons, flags))
 
@@ -125,7 +156,7 @@ def OptsMenu(title, vols=None, dirs=None, fields=None, checks=None, helpfun=None
     helpbutton.clicked.connect(lambda: print_help(main, helpfun))
 
     fn_name = title.replace(' ', '_').lower()
-    submit.clicked.connect(lambda: parse_inputs(fn_name, labels, linedits, vols, dirs, fields, flags))
+    submit.clicked.connect(lambda: parse_inputs(fn_name, labels, linedits, vols, dirs, fields, flags, on_run))
 
     return widget, linedits, labels
 
@@ -159,7 +190,7 @@ def checkbox_state(button, flags):
         flags[label] = True if button[label].isChecked() else False
 
 
-def parse_inputs(fn_name, labels, linedits, vols, dirs, fields, flags):
+def parse_inputs(fn_name, labels, linedits, vols, dirs, fields, flags, on_run=None):
     cmd = "ventmapper %s" % fn_name
 
     if vols:
@@ -191,6 +222,11 @@ def parse_inputs(fn_name, labels, linedits, vols, dirs, fields, flags):
 
     print("\n running VentMapp3r with the following command: \n\n %s \n" % cmd)
 
+    # the gui runs the command itself and keeps running
+    if on_run is not None:
+        on_run(cmd)
+        return
+
     subprocess.Popen("%s" % cmd, shell=True,
                      stdin=None, stdout=None, stderr=None, close_fds=True)
 
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import cProfile
+import io
+import os
+import pstats
+import subprocess
+import threading
+import time
+
+from ventmapper.utils import resources
+
+
+class TimedPopen(subprocess.Popen):
+    """ Popen recording the wall time of each external command (nipype interfaces run c3d / ants through it)
+    """
+    records = []
+    lock = threading.Lock()
+
+    def __init__(self, args, *popen_args, **popen_kwargs):
+        self._start = time.time()
+        self._recorded = False
+        super(TimedPopen, self).__init__(args, *popen_args, **popen_kwargs)
+
+        cmd = args if isinstance(args, str) else ' '.join(map(str, args))
+        self._exe = os.path.basename(cmd.split()[0]) if cmd.split() else cmd
+
+    def _record(self):
+        if self.returncode is not None and not self._recorded:
+            self._recorded = True
+            with TimedPopen.lock:
+                TimedPopen.records.append((self._exe, time.time() - self._start))
+
+    def wait(self, *args, **kwargs):
+        returncode = super(TimedPopen, self).wait(*args, **kwargs)
+        self._record()
+        return returncode
+
+    def poll(self):
+        returncode = super(TimedPopen, self).poll()
+        self._record()
+        return returncode
+
+
+def subprocess_summary(records):
+    """
+    Number of runs and total wall time of each external command, longest first
+    """
+    summary = {}
+    for exe, wall in records:
+        count, total = summary.get(exe, (0, 0.))
+        summary[exe] = (count + 1, total + wall)
+
+    return sorted(((exe, count, total) for exe, (count, total) in summary.items()), key=lambda row: -row[2])
+
+
+def profile_call(fn, args, out_prefix, top=30):
+    """
+    Run a function under the python profiler, timing the external commands it runs
+    :param fn: function to profile (ex: subcommand run function)
+    :param args: argument of the function
+    :param out_prefix: output prefix: writes <out_prefix>.prof (pstats) and <out_prefix>_profile.txt (summary)
+    :param top: number of functions in the summary
+    :return: return value of the function
+    """
+    popen = subprocess.Popen
+    subprocess.Popen = TimedPopen
+    TimedPopen.records = []
+
+    _, children_cpu = resources.cpu_times()
+    start = time.time()
+    profiler = cProfile.Profile()
+
+    try:
+        return profiler.runcall(fn, args)
+    finally:
+        wall = time.time() - start
+        subprocess.Popen = popen
+        _, end_children_cpu = resources.cpu_times()
+
+        prof_file = '%s.prof' % out_prefix
+        summary_file = '%s_profile.txt' % out_prefix
+        profiler.dump_stats(prof_file)
+
+        out = io.StringIO()
+        out.write("total wall time: %.2fs, subprocess cpu time: %.2fs\n" % (wall, end_children_cpu - children_cpu))
+
+        rows = subprocess_summary(TimedPopen.records)
+        out.write("\nexternal commands (%.2fs wall):\n\n" % sum(row[2] for row in rows))
+        out.write("%-40s %8s %12s\n" % ('command', 'runs', 'wall (s)'))
+        for exe, count, total in rows:
+            out.write("%-40s %8d %12.2f\n" % (exe, count, total))
+
+        for sort in ['cumulative', 'tottime']:
+            out.write("\nfunctions by %s time:\n" % sort)
+            stats = pstats.Stats(profiler, stream=out)
+            stats.strip_dirs().sort_stats(sort).print_stats(top)
+
+        with open(summary_file, 'w') as summary:
+            summary.write(out.getvalue())
+
+        print("\n profile saved to %s (summary: %s)" % (prof_file, summary_file))
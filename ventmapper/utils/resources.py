@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import resource
+import sys
+
+
+def _status_kb(field):
+    """
+    Read a memory field (in kB) of /proc/self/status, None if unavailable
+    """
+    try:
+        with open('/proc/self/status', 'r') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+
+    return None
+
+
+def _maxrss_bytes(who):
+    maxrss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kB on linux
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident memory of this process (linux only)
+    :return: True if the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process in bytes, since the last reset_peak_rss if supported
+    """
+    hwm = _status_kb('VmHWM')
+
+    return hwm * 1024 if hwm is not None else _maxrss_bytes(resource.RUSAGE_SELF)
+
+
+def children_peak_rss():
+    """
+    Largest peak resident memory of any terminated child process in bytes (ex: c3d, ants), over the lifetime
+    of this process: it is never reset, see children_peak_since
+    """
+    return _maxrss_bytes(resource.RUSAGE_CHILDREN)
+
+
+def children_peak_since(before):
+    """
+    Lifetime maximum of the children peak memory if it grew since a previous children_peak_rss
+    (then set by a child that terminated in between), None if it did not grow
+    :param before: children_peak_rss at the start of the measured block (bytes)
+    :return: bytes or None
+    """
+    peak = children_peak_rss()
+
+    return peak if peak > before else None
+
+
+def cpu_times():
+    """
+    Cpu time of this process and of its terminated child processes in seconds
+    :return: self cpu time, children cpu time
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+
+def io_bytes():
+    """
+    Bytes read and written by this process, including its terminated children (linux only)
+    :return: bytes read, bytes written (None if unavailable)
+    """
+    try:
+        with open('/proc/self/io', 'r') as proc_io:
+            counters = dict(line.split(':') for line in proc_io)
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+from ventmapper.utils import trace
+
+
+def data_hash(*arrays):
+    """
+    Hash the contents of numpy arrays
+    :return: hex digest
+    """
+    sha = hashlib.sha1()
+    for array in arrays:
+        sha.update(str((array.shape, array.dtype.str)).encode('utf-8'))
+        sha.update(np.ascontiguousarray(array).data)
+
+    return sha.hexdigest()
+
+
+class StageCache(object):
+    """ Cache of pipeline stage outputs, keyed by a hash of each stage's input files and parameters.
+    The manifest lives next to the outputs in the subject's pred_process dir. File hashes are remembered
+    by size and mtime so unchanged files are only read once.
+    """
+    def __init__(self, cache_dir, enabled=True):
+        self.enabled = enabled
+        self.manifest_file = os.path.join(cache_dir, 'stage_cache.json')
+        self.manifest = {'files': {}, 'stages': {}}
+        self.lock = threading.RLock()
+
+        if enabled and os.path.exists(self.manifest_file):
+            try:
+                with open(self.manifest_file, 'r') as json_file:
+                    self.manifest = json.load(json_file)
+            except ValueError:
+                print("\n could not read %s ... ignoring cached stages" % self.manifest_file)
+
+    def file_hash(self, path):
+        """
+        Content hash of a file
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+
+        with self.lock:
+            entry = self.manifest['files'].get(path)
+            if entry is not None and entry['stamp'] == stamp:
+                return entry['hash']
+
+        sha = hashlib.sha1()
+        with open(path, 'rb') as in_file:
+            for chunk in iter(lambda: in_file.read(1 << 20), b''):
+                sha.update(chunk)
+
+        with self.lock:
+            self.manifest['files'][path] = {'stamp': stamp, 'hash': sha.hexdigest()}
+
+        return sha.hexdigest()
+
+    def lookup(self, stage, inputs=(), params=None):
+        """
+        Check whether a stage has cached outputs for these inputs and parameters
+        :param stage: stage id (ex: mask:subj_T1_nu)
+        :param inputs: input files
+        :param params: json serializable stage parameters
+        :return: whether cached outputs can be reused, stage key (to store outputs with)
+        """
+        if not self.enabled:
+            return False, None
+
+        key = hashlib.sha1(json.dumps([stage, [self.file_hash(in_file) for in_file in inputs], params],
+                                      sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+        with self.lock:
+            entry = self.manifest['stages'].get(stage)
+
+        if entry is None or entry['key'] != key:
+            return False, key
+
+        # outputs must still be there and unchanged since they were cached
+        for out_file, out_hash in entry['outputs'].items():
+            if not os.path.exists(out_file) or self.file_hash(out_file) != out_hash:
+                return False, key
+
+        return True, key
+
+    def store(self, stage, key, outputs):
+        """
+        Record the outputs of a stage
+        """
+        if not self.enabled:
+            return
+
+        out_hashes = {os.path.abspath(out_file): self.file_hash(out_file) for out_file in outputs}
+
+        with self.lock:
+            self.manifest['stages'][stage] = {'key': key, 'outputs': out_hashes}
+            self.save()
+
+    def run(self, stage, fn, inputs, outputs, params=None):
+        """
+        Run a stage unless its outputs are cached for the same inputs and parameters
+        :param fn: function generating the outputs
+        :return: whether the stage was run
+        """
+        with trace.stage(stage) as record:
+            cached, key = self.lookup(stage, inputs, params)
+            record['cached'] = cached
+
+            if cached:
+                print("\n %s: inputs unchanged, using cached outputs" % stage)
+                return False
+
+            fn()
+            self.store(stage, key, outputs)
+
+        return True
+
+    def save(self):
+        with self.lock:
+            tmp_file = '%s.tmp' % self.manifest_file
+            with open(tmp_file, 'w') as json_file:
+                json.dump(self.manifest, json_file)
+            os.replace(tmp_file, self.manifest_file)
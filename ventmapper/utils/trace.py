@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import contextlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from ventmapper.utils import resources
+
+TRACE_NAME = 'trace.jsonl'
+
+# when set, stage boundaries are also printed (as '@@stage <status> <name>' lines) for the gui to follow progress
+PROGRESS_ENV = 'VENTMAPPER_PROGRESS'
+PROGRESS_PREFIX = '@@stage'
+
+# tracers of the subjects being processed (innermost last) and stages being measured
+_tracers = []
+_open_records = []
+_lock = threading.RLock()
+
+
+class Tracer(object):
+    """ Appends stage records of a subject to logs/trace.jsonl in its dir
+    """
+    def __init__(self, subj_dir, subj=None, command=None, run=None):
+        self.trace_file = os.path.join(subj_dir, 'logs', TRACE_NAME)
+        self.subj = subj if subj else os.path.basename(os.path.abspath(subj_dir))
+        self.command = command
+        self.run = run if run else datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+
+    def write(self, record):
+        record = dict(record, subj=self.subj, command=self.command, run=self.run)
+
+        with _lock:
+            os.makedirs(os.path.dirname(self.trace_file), exist_ok=True)
+            with open(self.trace_file, 'a') as trace_file:
+                trace_file.write(json.dumps(record) + '\n')
+
+
+def _reset_peak():
+    # keep the peak reached so far by the enclosing stages before resetting it
+    with _lock:
+        peak = resources.peak_rss()
+        for record in _open_records:
+            record['_peak'] = max(record['_peak'], peak)
+        resources.reset_peak_rss()
+
+
+@contextlib.contextmanager
+def measure(name, **fields):
+    """
+    Measure a block: wall and cpu time, subprocess cpu time, peak rss and bytes read / written, and the lifetime
+    max rss of subprocesses if it was raised within the block
+    (process-wide: concurrent stages of the same process are counted in each other)
+    :param name: stage name
+    :param fields: extra fields of the record
+    :return: record, filled when the block exits
+    """
+    record = dict(fields, stage=name, pid=os.getpid(), _peak=0)
+
+    _reset_peak()
+    with _lock:
+        _open_records.append(record)
+
+    cpu, children_cpu = resources.cpu_times()
+    children_peak = resources.children_peak_rss()
+    read_bytes, write_bytes = resources.io_bytes()
+    start = time.time()
+    record['status'] = 'done'
+
+    try:
+        yield record
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        end = time.time()
+        end_cpu, end_children_cpu = resources.cpu_times()
+        end_read, end_write = resources.io_bytes()
+
+        with _lock:
+            _open_records.remove(record)
+            peak = max(record.pop('_peak'), resources.peak_rss())
+
+        record.update(start=start, end=end, wall_s=end - start, cpu_s=end_cpu - cpu,
+                      subprocess_cpu_s=end_children_cpu - children_cpu, peak_rss_mb=peak / 2. ** 20)
+
+        # the children peak is a lifetime maximum: only known for this stage when one of its subprocesses raised it
+        children_max = resources.children_peak_since(children_peak)
+        if children_max is not None:
+            record.update(subprocess_max_rss_mb=children_max / 2. ** 20)
+        if read_bytes is not None and end_read is not None:
+            record.update(read_mb=(end_read - read_bytes) / 2. ** 20, write_mb=(end_write - write_bytes) / 2. ** 20)
+
+
+def progress(name, status):
+    """
+    Print a stage boundary for the gui job queue (only if PROGRESS_ENV is set)
+    :param name: stage name
+    :param status: start, done or failed
+    """
+    if os.environ.get(PROGRESS_ENV):
+        print("%s %s %s" % (PROGRESS_PREFIX, status, name), flush=True)
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Trace a stage into the trace of the current subject (no-op outside of tracing)
+    :param name: stage name (ex: standardize:t1)
+    :param fields: extra fields of the record
+    :return: record, extra fields can be added to it within the block
+    """
+    with _lock:
+        tracer = _tracers[-1] if _tracers else None
+
+    progress(name, 'start')
+    status = 'failed'
+
+    try:
+        if tracer is None:
+            yield fields
+        else:
+            try:
+                with measure(name, **fields) as record:
+                    yield record
+            finally:
+                tracer.write(record)
+        status = 'done'
+    finally:
+        progress(name, status)
+
+
+@contextlib.contextmanager
+def tracing(subj_dir, subj=None, command=None, run=None):
+    """
+    Trace the stages run within this block into the subject's logs/trace.jsonl, with a record of the whole block
+    :param subj_dir: subject dir
+    :param subj: subject name (default: name of subject dir)
+    :param command: command being traced (ex: seg_vent)
+    :param run: id of the run to add records to (default: enclosing run, or a new run)
+    """
+    with _lock:
+        # nested commands (ex: seg_qc within seg_vent) belong to the same run
+        if run is None and _tracers:
+            run = _tracers[-1].run
+        tracer = Tracer(subj_dir, subj, command, run)
+        _tracers.append(tracer)
+
+    try:
+        with stage(command if command else 'total'):
+            yield tracer
+    finally:
+        with _lock:
+            _tracers.remove(tracer)
+
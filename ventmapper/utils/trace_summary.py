@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argcomplete
+import argparse
+import glob
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from ventmapper.utils.trace import TRACE_NAME
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage='%(prog)s -i [ in_dir ] \n\n'
+                                           "Summarize stage traces of a cohort to find slow stages and "
+                                           "outlier subjects")
+
+    required = parser.add_argument_group('required arguments')
+
+    required.add_argument('-i', '--in_dir', type=str, required=True, metavar='',
+                          help="directory of subjects (or a subject dir)")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-c', '--command', type=str, metavar='', default=None,
+                          help="only summarize stages of this command, ex: seg_vent (default: all)")
+    optional.add_argument('-a', '--all_runs', help="summarize all runs instead of the latest run of each subject",
+                          action='store_true')
+    optional.add_argument('-z', '--zscore', type=float, metavar='', default=3.5,
+                          help="robust z-score of stage time above which a subject is an outlier "
+                               "(default: %(default)s)")
+    optional.add_argument('-m', '--min_s', type=float, metavar='', default=1.,
+                          help="minimum time above the median of a stage for a subject to be an outlier "
+                               "(default: %(default)s)")
+    optional.add_argument('-o', '--out_csv', type=str, metavar='', default='trace_summary.csv',
+                          help="output csv of stage statistics, outliers are saved with an _outliers suffix "
+                               "(default: %(default)s)")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    return args.in_dir, args.command, args.all_runs, args.zscore, args.min_s, args.out_csv
+
+
+def read_traces(in_dir):
+    """
+    Read the stage records of all subjects
+    :param in_dir: directory of subjects (or a subject dir)
+    :return: dataframe of records
+    """
+    trace_files = glob.glob(os.path.join(in_dir, '*', 'logs', TRACE_NAME)) + \
+        glob.glob(os.path.join(in_dir, 'logs', TRACE_NAME))
+
+    records = []
+    for trace_file in sorted(trace_files):
+        with open(trace_file, 'r') as in_file:
+            for line in in_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # partially written record of an interrupted run
+                    continue
+
+    return pd.DataFrame(records)
+
+
+def stage_times(df, all_runs=False):
+    """
+    Time and memory of each stage per subject run (records of a stage within a run are summed)
+    """
+    if not all_runs:
+        df = df[df['run'] == df.groupby('subj')['run'].transform('max')]
+
+    return df.groupby(['subj', 'run', 'command', 'stage']).agg({'wall_s': 'sum', 'cpu_s': 'sum',
+                                                                'subprocess_cpu_s': 'sum',
+                                                                'peak_rss_mb': 'max'}).reset_index()
+
+
+def summarize_stages(times):
+    """
+    Statistics of each stage across subjects, slowest stages (by total time) first
+    """
+    grouped = times.groupby(['command', 'stage'])
+
+    summary = pd.DataFrame({'subjects': grouped['subj'].nunique(),
+                            'median_s': grouped['wall_s'].median(),
+                            'p95_s': grouped['wall_s'].quantile(0.95),
+                            'max_s': grouped['wall_s'].max(),
+                            'total_s': grouped['wall_s'].sum(),
+                            'cpu_s': grouped['cpu_s'].median(),
+                            'subprocess_cpu_s': grouped['subprocess_cpu_s'].median(),
+                            'peak_rss_mb': grouped['peak_rss_mb'].max()})
+
+    return summary.sort_values('total_s', ascending=False)
+
+
+def find_outliers(times, zscore=3.5, min_s=1.):
+    """
+    Subjects with a stage much slower than for other subjects (robust z-score from the median absolute deviation)
+    """
+    grouped = times.groupby(['command', 'stage'])['wall_s']
+    median = grouped.transform('median')
+    mad = grouped.transform(lambda wall: np.median(np.abs(wall - np.median(wall))))
+
+    times = times.assign(median_s=median, zscore=0.6745 * (times['wall_s'] - median) / mad.replace(0, np.nan))
+
+    outliers = times[(times['zscore'] > zscore) & (times['wall_s'] - times['median_s'] >= min_s)]
+
+    return outliers[['subj', 'command', 'stage', 'wall_s', 'median_s', 'zscore']].sort_values('zscore',
+                                                                                           ascending=False)
+
+
+def main(args):
+    parser = parsefn()
+    in_dir, command, all_runs, zscore, min_s, out_csv = parse_inputs(parser, args)
+
+    df = read_traces(in_dir)
+    if df.empty:
+        print("\n no traces found in %s" % in_dir)
+        return
+
+    if command is not None:
+        df = df[df['command'] == command]
+
+    times = stage_times(df, all_runs)
+    summary = summarize_stages(times)
+    outliers = find_outliers(times, zscore, min_s)
+
+    pd.set_option('display.width', 200)
+    print("\n stages of %d subjects (slowest first):\n\n%s" % (times['subj'].nunique(), summary.round(2).to_string()))
+
+    if outliers.empty:
+        print("\n no outlier subjects")
+    else:
+        print("\n outlier subjects:\n\n%s" % outliers.round(2).to_string(index=False))
+
+    summary.round(3).to_csv(out_csv)
+    outliers.round(3).to_csv('%s_outliers.csv' % os.path.splitext(out_csv)[0], index=False)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])